@@ -0,0 +1,55 @@
+import time
+import argparse
+import numpy as np
+import torch
+import torch.optim as optim
+
+from models.graphcnn import *
+from batch import graph_loader
+from util import load_data
+from main import train
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the training step of the sparse and dense minibatch adjacency')
+    parser.add_argument('--sourcedir', type=str, default='data', help='path to the data directory')
+    parser.add_argument('--cachedir', type=str, default=None, help='path to cache the preprocessed graphs, not cached if not given')
+    parser.add_argument('--sparsity', type=int, default=30, help='sparsity M of graph adjacency')
+    parser.add_argument('--input_feature', type=str, default='one_hot', help='input feature type', choices=['one_hot', 'coordinate', 'mean_bold'])
+    parser.add_argument('--batch_size', type=int, default=32, help='input minibatch size for training')
+    parser.add_argument('--iters_per_epoch', type=int, default=20, help='number of timed iterations')
+    parser.add_argument('--num_layers', type=int, default=5, help='number of the GNN layers')
+    parser.add_argument('--num_mlp_layers', type=int, default=2, help='number of layers for the MLP. 1 means linear model.')
+    parser.add_argument('--hidden_dim', type=int, default=64, help='number of hidden units')
+    parser.add_argument('--beta', type=float, default=0.05, help='coefficient for infograph regularizer')
+    parser.add_argument('--graph_pooling_type', type=str, default="sum", choices=["sum", "average"], help='Pooling for over nodes in a graph: sum or average')
+    parser.add_argument('--neighbor_pooling_type', type=str, default="sum", choices=["sum", "average"], help='Pooling for over neighboring nodes: sum or average')
+    parser.add_argument('--learn_eps', action="store_true", help='whether to learn the epsilon weighting for the center nodes.')
+    parser.add_argument('--num_threads', type=int, default=0, help='number of cpu threads, pytorch default if 0')
+    args = parser.parse_args()
+
+    if args.num_threads > 0:
+        torch.set_num_threads(args.num_threads)
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    graphs, num_classes = load_data(args.sourcedir, args.sparsity, args.input_feature, args.cachedir)
+
+    for adjacency in ['sparse', 'dense']:
+        torch.manual_seed(0)
+        np.random.seed(0)
+        model = GIN_InfoMaxReg(args.num_layers, args.num_mlp_layers, graphs[0].node_features.shape[1], args.hidden_dim, num_classes, 0.5, args.learn_eps, args.graph_pooling_type, args.neighbor_pooling_type, device, adjacency=='dense').to(device)
+        store = model.graph_store(graphs)
+        optimizer = optim.Adam(model.parameters(), lr=0.005)
+
+        #warm up
+        train(args, model, device, graph_loader(store, args.batch_size, 2), optimizer, args.beta, 0)
+
+        if device.type == 'cuda': torch.cuda.synchronize()
+        start = time.time()
+        train(args, model, device, graph_loader(store, args.batch_size, args.iters_per_epoch), optimizer, args.beta, 0)
+        if device.type == 'cuda': torch.cuda.synchronize()
+        elapsed = time.time() - start
+        print('{}: {:.1f} ms per training step'.format(adjacency, 1000*elapsed/args.iters_per_epoch))
+
+
+if __name__ == '__main__':
+    main()
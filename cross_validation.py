@@ -0,0 +1,55 @@
+import os
+import argparse
+import multiprocessing
+import multiprocessing.connection
+import torch
+
+from main import get_parser, run_fold
+from util import load_data
+
+#graphs loaded once in the parent process, inherited by the forked fold workers
+fold_data = {}
+
+
+def train_fold(args, num_threads):
+    torch.set_num_threads(num_threads)
+    run_fold(args, fold_data['graphs'], fold_data['num_classes'])
+
+
+def main():
+    parser = get_parser()
+    parser.description = 'PyTorch GIN fMRI cross-validation of all folds from one data load'
+    parser.add_argument('--folds', type=int, nargs='+', default=list(range(10)), help='indices of the folds to train')
+    parser.add_argument('--fold_workers', type=int, default=0, help='number of folds trained concurrently, one per cpu up to the number of folds if 0')
+    parser.add_argument('--threads_per_fold', type=int, default=0, help='number of torch threads of each fold process, cpus divided by fold_workers if 0')
+    args = parser.parse_args()
+
+    fold_workers = args.fold_workers if args.fold_workers > 0 else min(len(args.folds), os.cpu_count())
+    threads_per_fold = args.threads_per_fold if args.threads_per_fold > 0 else max(1, os.cpu_count() // fold_workers)
+
+    graphs, num_classes = load_data(args.sourcedir, args.sparsity, args.input_feature, args.cachedir, args.num_workers, args.edge_weight, args.targets, args.connectivity)
+    fold_data['graphs'] = graphs
+    fold_data['num_classes'] = num_classes
+
+    fold_args = [argparse.Namespace(**dict(vars(args), fold_idx=fold_idx)) for fold_idx in args.folds]
+    #one forked process per fold shares the loaded graphs without pickling them. Unlike the workers of a Pool, the processes are
+    #not daemonic, so that they can start the DataLoader workers of --loader_workers
+    context = multiprocessing.get_context('fork')
+    running = {}
+    while fold_args or running:
+        while fold_args and len(running) < fold_workers:
+            current_args = fold_args.pop(0)
+            process = context.Process(target=train_fold, args=(current_args, threads_per_fold))
+            process.start()
+            running[process.sentinel] = (current_args.fold_idx, process)
+        for sentinel in multiprocessing.connection.wait(list(running.keys())):
+            fold_idx, process = running.pop(sentinel)
+            process.join()
+            if process.exitcode != 0:
+                for _, other in running.values():
+                    other.terminate()
+                raise RuntimeError('fold {} exited with code {}'.format(fold_idx, process.exitcode))
+            print('fold {} done'.format(fold_idx))
+
+if __name__ == '__main__':
+    main()
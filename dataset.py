@@ -2,27 +2,31 @@ import os
 import numpy as np
 import pandas as pd
 
+#tables and encodings of the metadata files, keyed by (name, path, mtime) so that every process reads each file once
+metadata_cache = {}
+
+
+def cached(path, name, fn):
+    key = (name, os.path.abspath(path), os.stat(path).st_mtime_ns)
+    if not key in metadata_cache:
+        metadata_cache[key] = fn()
+    return metadata_cache[key]
+
 
 # Class of behavioral measurments
 class DataBehavioral(object):
     def __init__(self, sourcedir):
         super(DataBehavioral, self).__init__()
-        self.df = pd.read_csv(os.path.join(sourcedir, 'behavioral', 'hcp.csv')).set_index('Subject')
+        self.path = os.path.join(sourcedir, 'behavioral', 'hcp.csv')
+        self.df = cached(self.path, 'behavioral', lambda: pd.read_csv(self.path).set_index('Subject'))
 
     def get_feature(self, feature):
         behavioral_features = self.df[feature].to_dict()
         behavioral_label = {}
 
         for f in feature:
-            behavioral_label[f] = {}
-            seen = []
-            for v in behavioral_features[f].values():
-                if v not in seen:
-                    seen.append(v)
-            seen.sort()
-            for k, v in behavioral_features[f].items():
-                label = seen.index(v)
-                behavioral_label[f][k] = label
+            #labels are indices of the sorted unique values, missing values are labeled -1
+            behavioral_label[f] = cached(self.path, ('label', f), lambda: dict(zip(self.df.index.tolist(), pd.factorize(self.df[f], sort=True)[0].tolist())))
 
         return behavioral_features, behavioral_label # dict {subject: feature_string} / dict {subject: label}
 
@@ -31,71 +35,233 @@ class DataBehavioral(object):
 class DataNodes(object):
     def __init__(self, sourcedir):
         super(DataNodes, self).__init__()
-        self.df = pd.read_csv(os.path.join(sourcedir, 'roi', '7_400.txt'), index_col=0, header=None, delimiter='\t')
-        self.features = self.df[1].str.split("_", expand=True)
-        self.features.columns = ['YeoNetwork', 'Hemisphere', 'Network', 'Region', 'Index']
-        self.df_coord = pd.read_csv(os.path.join(sourcedir, 'roi', '7_400_coord.csv'), index_col=0)[1:]
-
-        for i in self.features.index:
-            row = self.features.loc[i]
-            if row.isnull().any():
-                row[4] = row[3]
-                row[3] = row[2]
+        self.sourcedir = sourcedir
+        self.packed = DataPacked(sourcedir) if DataPacked.exists(sourcedir) else None
+        self.path = os.path.join(sourcedir, 'roi', '7_400.txt')
+        self.coord_path = os.path.join(sourcedir, 'roi', '7_400_coord.csv')
+        self.df = cached(self.path, 'roi', lambda: pd.read_csv(self.path, index_col=0, header=None, delimiter='\t'))
+        self.features = cached(self.path, 'roi_features', lambda: split_roi_names(self.df[1]))
+        self.df_coord = cached(self.coord_path, 'roi_coord', lambda: pd.read_csv(self.coord_path, index_col=0)[1:])
 
-    def __call__(self, subject):
-        self.df_timeseries = pd.read_csv(os.path.join(sourcedir, 'timeseries', f'{subject}.txt'), index_col=False, header=None, delimiter='\t').dropna(axis='columns').to_numpy()
+    def __call__(self, subject, timeseries_stats=None):
+        ###per-ROI moments of the timeseries accumulated chunk by chunk, or given if already computed (e.g. by DataEdges)
+        if timeseries_stats is None:
+            timeseries_stats = TimeseriesStats(covariance=False)
+            for chunk in iter_timeseries(self.sourcedir, self.packed, subject):
+                timeseries_stats.update(chunk)
+        self.timeseries_stats = timeseries_stats
 
     def get_feature(self, type): # List of 'YeoNetwork', 'Hemisphere', 'Network', 'Region', 'Index'
         feature=['Hemisphere', 'Region', 'Network', 'Index']
         if type=='one_hot':
-            filtered_features = self.features[feature]
-            node_features = filtered_features.apply(lambda x: '_'.join(x), axis='columns').to_dict()
-            node_label = {}
-
-            seen = []
-            for v in node_features.values():
-                if v not in seen:
-                    seen.append(v)
-            for k, v in node_features.items():
-                label = seen.index(v)
-                node_label[k] = label
-            return node_features, node_label # dict {roi: feature_string} / dict {roi: label_value}
+            return cached(self.path, 'one_hot', lambda: self.encode_one_hot(feature)) # dict {roi: feature_string} / dict {roi: label_value}
 
         elif type=='coordinate':
-            filtered_features = self.df_coord[['R','A','S']]
-            node_label_dict = filtered_features.to_dict()
-            node_label = {}
-            for k in node_label_dict['R'].keys():
-                node_label[k] = (node_label_dict['R'][k], node_label_dict['A'][k], node_label_dict['S'][k])
-            return node_label_dict, node_label # dict {R,A,S:{roi: coordinate}} / dict {roi: tuple (R,A,S) coordinate}
+            return cached(self.coord_path, 'coordinate', self.encode_coordinate) # dict {R,A,S:{roi: coordinate}} / dict {roi: tuple (R,A,S) coordinate}
 
         elif type=='mean_bold':
-            node_label_numpy = np.mean(self.df_timeseries, axis=0)
+            node_label_numpy = self.timeseries_stats.mean
             node_label_numpy = (node_label_numpy - node_label_numpy.mean()) / (node_label_numpy.std() + 1e-8)
             node_label = {}
             for i, timeseries in enumerate(node_label_numpy):
                 node_label[i] = tuple([timeseries])
             return node_label_numpy, node_label
 
+        elif type=='moments_bold':
+            #mean, standard deviation, skewness and kurtosis of each ROI, each normalized over the ROIs
+            node_label_numpy = np.stack([self.timeseries_stats.mean, self.timeseries_stats.get_std(), self.timeseries_stats.get_skewness(), self.timeseries_stats.get_kurtosis()], axis=1)
+            node_label_numpy = (node_label_numpy - node_label_numpy.mean(0)) / (node_label_numpy.std(0) + 1e-8)
+            node_label = {}
+            for i, moments in enumerate(node_label_numpy):
+                node_label[i] = tuple(moments)
+            return node_label_numpy, node_label
+
         else:
             raise Exception('unknown node feature type')
 
+    def encode_one_hot(self, feature):
+        ###labels are indices of the unique ROI names in order of appearance
+        names = self.features[feature[0]].str.cat([self.features[f] for f in feature[1:]], sep='_')
+        node_label = dict(zip(names.index.tolist(), pd.factorize(names)[0].tolist()))
+        return names.to_dict(), node_label
+
+    def encode_coordinate(self):
+        filtered_features = self.df_coord[['R','A','S']]
+        node_label = dict(zip(filtered_features.index.tolist(), filtered_features.itertuples(index=False, name=None)))
+        return filtered_features.to_dict(), node_label
+
 
 # Class of edges, i.e. FC features
 class DataEdges(object):
-    def __init__(self, sourcedir):
+    def __init__(self, sourcedir, source='precomputed'):
+        '''
+            source: precomputed connectivity matrices, or Pearson correlation of the timeseries accumulated chunk by chunk
+        '''
         super(DataEdges, self).__init__()
         self.sourcedir = sourcedir
+        self.source = source
+        self.packed = DataPacked(sourcedir) if DataPacked.exists(sourcedir) else None
+        self.timeseries_stats = None
 
     def __call__(self, subject):
-        self.df = pd.read_csv(os.path.join(self.sourcedir, 'connectivity', f'r{subject}.txt'), index_col=False, header=None, delimiter='\t').dropna(axis='columns').to_numpy()
+        if self.source == 'timeseries':
+            self.timeseries_stats = TimeseriesStats()
+            for chunk in iter_timeseries(self.sourcedir, self.packed, subject):
+                self.timeseries_stats.update(chunk)
+            self.df = self.timeseries_stats.get_correlation()
+        elif self.packed is not None and self.packed.has_connectivity(subject):
+            self.df = self.packed.get_connectivity(subject)
+        else:
+            self.df = read_matrix(os.path.join(self.sourcedir, 'connectivity', f'r{subject}.txt'))
+
+    def get_subjects(self):
+        subjects = set()
+        if self.source == 'timeseries':
+            if os.path.isdir(os.path.join(self.sourcedir, 'timeseries')):
+                subjects.update([subject.split('.')[0] for subject in os.listdir(os.path.join(self.sourcedir, 'timeseries'))])
+            if self.packed is not None:
+                subjects.update(self.packed.subjects[np.diff(self.packed.timeseries_offsets) > 0])
+            return sorted(subjects)
+        if os.path.isdir(os.path.join(self.sourcedir, 'connectivity')):
+            subjects.update([subject.split('.')[0][1:] for subject in os.listdir(os.path.join(self.sourcedir, 'connectivity'))])
+        if self.packed is not None:
+            subjects.update(self.packed.subjects[self.packed.connectivity_index >= 0])
+        return sorted(subjects)
 
     def get_adjacency(self, threshold):
-        mask = (self.df > np.percentile(self.df, threshold)).astype(np.uint8)
-        nodes, neighbors = np.nonzero(mask)
-        sparse_mask = {}
-        for i, node in enumerate(nodes):
-            if neighbors[i] > node:
-                if not node in sparse_mask: sparse_mask[node] = [neighbors[i]]
-                else: sparse_mask[node].append(neighbors[i])
+        mask, edges = self.get_edges(threshold)
+        nodes, start = np.unique(edges[:, 0], return_index=True)
+        sparse_mask = dict(zip(nodes, [neighbors.tolist() for neighbors in np.split(edges[:, 1], start[1:])]))
         return mask, sparse_mask # matrix adjacency / dict {roi: neighbor_roi}
+
+    def get_edges(self, threshold):
+        mask = (self.df > np.percentile(self.df, threshold)).astype(np.uint8)
+        edges = np.stack(np.nonzero(np.triu(mask, 1)), axis=1)
+        return mask, edges # matrix adjacency / array (num_edges, 2) of upper triangular edges sorted by roi
+
+    def get_edges_nested(self, thresholds):
+        ###edges of several thresholds from one sort of the upper triangle, the edges of a higher threshold are a prefix of a lower one
+        triu_idx = np.triu_indices(self.df.shape[0], 1)
+        weights = self.df[triu_idx]
+        order = np.argsort(weights, kind='stable')[::-1]
+        #same edges as get_edges: weights strictly above the percentile of the full matrix
+        percentiles = np.percentile(self.df, thresholds)
+        counts = len(weights) - np.searchsorted(weights[order[::-1]], percentiles, side='right')
+        edges = np.stack([triu_idx[0][order], triu_idx[1][order]], axis=1)
+        return edges, weights[order], counts # array (num_edges, 2) of upper triangular edges sorted by decreasing weight / weights of the edges / number of edges of each threshold
+
+
+# Class of the packed connectivity and timeseries store, see pack_data.py
+class DataPacked(object):
+    def __init__(self, sourcedir):
+        super(DataPacked, self).__init__()
+        packdir = os.path.join(sourcedir, 'packed')
+        self.subjects = np.load(os.path.join(packdir, 'subjects.npy'))
+        self.subject_index = {subject: i for i, subject in enumerate(self.subjects.tolist())}
+        self.connectivity_index = np.load(os.path.join(packdir, 'connectivity_index.npy'))
+        self.connectivity = np.load(os.path.join(packdir, 'connectivity.npy'), mmap_mode='r')
+        self.timeseries_offsets = np.load(os.path.join(packdir, 'timeseries_offsets.npy'))
+        self.timeseries = np.load(os.path.join(packdir, 'timeseries.npy'), mmap_mode='r')
+        self.num_rois = int(round((np.sqrt(8*self.connectivity.shape[1]+1)-1)/2))
+        self.triu_idx = np.triu_indices(self.num_rois)
+
+    @staticmethod
+    def exists(sourcedir):
+        return os.path.isfile(os.path.join(sourcedir, 'packed', 'subjects.npy'))
+
+    def has_connectivity(self, subject):
+        return subject in self.subject_index and self.connectivity_index[self.subject_index[subject]] >= 0
+
+    def has_timeseries(self, subject):
+        i = self.subject_index.get(subject)
+        return i is not None and self.timeseries_offsets[i+1] > self.timeseries_offsets[i]
+
+    def get_connectivity(self, subject):
+        ###symmetric matrix from the stored upper triangle
+        upper = self.connectivity[self.connectivity_index[self.subject_index[subject]]]
+        matrix = np.empty((self.num_rois, self.num_rois), dtype=upper.dtype)
+        matrix[self.triu_idx] = upper
+        matrix[self.triu_idx[1], self.triu_idx[0]] = upper
+        return matrix
+
+    def get_timeseries(self, subject):
+        ###zero-copy view into the memory-mapped timeseries
+        i = self.subject_index[subject]
+        return self.timeseries[self.timeseries_offsets[i]:self.timeseries_offsets[i+1]]
+
+
+# Class of the streaming moments of a timeseries, i.e. (time x ROI) chunks merged with the pairwise update of Chan and Pebay
+class TimeseriesStats(object):
+    def __init__(self, covariance=True):
+        '''
+            covariance: If True, the co-moment matrix of the ROIs is accumulated for get_correlation
+        '''
+        super(TimeseriesStats, self).__init__()
+        self.covariance = covariance
+        self.n = 0
+        self.mean = 0.
+        self.m2 = 0.
+        self.m3 = 0.
+        self.m4 = 0.
+        self.comoment = 0.
+
+    def update(self, chunk):
+        chunk = np.asarray(chunk, dtype=np.float64)
+        n_b = chunk.shape[0]
+        if n_b == 0: return
+        mean_b = chunk.mean(0)
+        centered = chunk - mean_b
+        m2_b = (centered**2).sum(0)
+        m3_b = (centered**3).sum(0)
+        m4_b = (centered**4).sum(0)
+
+        n_a, n = self.n, self.n + n_b
+        delta = mean_b - self.mean
+        self.m4 = self.m4 + m4_b + delta**4*n_a*n_b*(n_a**2 - n_a*n_b + n_b**2)/n**3 + 6*delta**2*(n_a**2*m2_b + n_b**2*self.m2)/n**2 + 4*delta*(n_a*m3_b - n_b*self.m3)/n
+        self.m3 = self.m3 + m3_b + delta**3*n_a*n_b*(n_a - n_b)/n**2 + 3*delta*(n_a*m2_b - n_b*self.m2)/n
+        self.m2 = self.m2 + m2_b + delta**2*n_a*n_b/n
+        if self.covariance:
+            self.comoment = self.comoment + centered.T @ centered + np.outer(delta, delta)*n_a*n_b/n
+        self.mean = self.mean + delta*n_b/n
+        self.n = n
+
+    def get_std(self):
+        return np.sqrt(self.m2 / self.n)
+
+    def get_skewness(self):
+        return np.sqrt(self.n) * self.m3 / (self.m2**1.5 + 1e-12)
+
+    def get_kurtosis(self):
+        ###excess kurtosis
+        return self.n * self.m4 / (self.m2**2 + 1e-12) - 3
+
+    def get_correlation(self):
+        ###Pearson correlation matrix of the ROIs
+        std = np.sqrt(np.diag(self.comoment))
+        return self.comoment / np.outer(std, std)
+
+
+def iter_timeseries(sourcedir, packed, subject, chunksize=256):
+    ###chunks of timepoints of the packed timeseries, or of the text file without reading it whole
+    if packed is not None and packed.has_timeseries(subject):
+        timeseries = packed.get_timeseries(subject)
+        for start in range(0, len(timeseries), chunksize):
+            yield timeseries[start:start+chunksize]
+    else:
+        for chunk in pd.read_csv(os.path.join(sourcedir, 'timeseries', f'{subject}.txt'), index_col=False, header=None, delimiter='\t', chunksize=chunksize):
+            #empty columns of the trailing delimiters
+            yield chunk.dropna(axis='columns', how='all').to_numpy()
+
+
+def split_roi_names(names):
+    features = names.str.split("_", expand=True).reindex(columns=range(5))
+    features.columns = ['YeoNetwork', 'Hemisphere', 'Network', 'Region', 'Index']
+    #names without a region: the network is used as the region
+    missing = features.isnull().any(axis=1)
+    features.loc[missing, 'Index'] = features.loc[missing, 'Region']
+    features.loc[missing, 'Region'] = features.loc[missing, 'Network']
+    return features
+
+
+def read_matrix(path):
+    return pd.read_csv(path, index_col=False, header=None, delimiter='\t').dropna(axis='columns').to_numpy()
@@ -1,54 +1,101 @@
 import os
 import argparse
 import numpy as np
-import pandas as pd
+from scipy.stats import rankdata
 
 
 def main():
     parser = argparse.ArgumentParser(description='compute robustness of the saliency mapping')
-    parser.add_argument('--expdir', type=str, default='results/graph_neural_mapping', help='path to the experiment results')
+    parser.add_argument('--expdirs', type=str, nargs='+', default=['results/graph_neural_mapping'], help='paths to the experiment results, e.g. one per random seed')
     parser.add_argument('--saliency', type=str, default='saliency_female', help='saliency type')
-    parser.add_argument('--topk', type=int, default=20, help='top k items to compare robustness')
+    parser.add_argument('--topk', type=int, nargs='+', default=[20], help='top k items to compare robustness')
+    parser.add_argument('--fold_idx', nargs='+', default=['0','1','2','3','4','5','6','7','8','9'], help='fold indices of the full saliency map')
+    parser.add_argument('--groups', nargs='+', default=None, help='comma separated fold indices of each partial saliency map, every single fold and the two halves of the folds if not given')
+    parser.add_argument('--savepath', type=str, default=None, help='path to save the robustness csv, not saved if not given')
     opt = parser.parse_args()
 
+    if opt.groups is None:
+        half = len(opt.fold_idx) // 2
+        opt.groups = opt.fold_idx + [','.join(opt.fold_idx[:half]), ','.join(opt.fold_idx[half:])]
+    groups = [group.split(',') for group in opt.groups]
 
-    full_folds = pd.read_csv(os.path.join(opt.expdir, 'saliency_nii', f'{opt.saliency}.csv'))
-    one_folds = [pd.read_csv(os.path.join(opt.expdir, 'saliency_nii_fold{}'.format(i), f'{opt.saliency}.csv')) for i in range(10)]
-    five_folds = [pd.read_csv(os.path.join(opt.expdir, 'saliency_nii_fold{}'.format(i), f'{opt.saliency}.csv')) for i in ['01234', '56789']]
+    ###saliency of each ROI summed over the subjects and nodes of each fold of each experiment (num experiments x num folds x num rois)
+    fold_sums, fold_counts = zip(*[load_fold_saliency(expdir, opt.saliency, opt.fold_idx) for expdir in opt.expdirs])
+    fold_sums = np.stack(fold_sums)
+    fold_counts = np.stack(fold_counts)
 
-    full_one_match = count_matches(full_folds, one_folds, opt.topk)
-    full_one_match_mean = np.mean(full_one_match)
-    full_one_match_std = np.std(full_one_match)
-    one_folds_robustness = 100*full_one_match_mean / opt.topk
-    one_folds_robustness_std = 100*full_one_match_std / opt.topk
-
-
-    full_five_match = count_matches(full_folds, five_folds, opt.topk)
-    full_five_match_mean = np.mean(full_five_match)
-    full_five_match_std = np.std(full_five_match)
-    five_folds_robustness = 100*full_five_match_mean / opt.topk
-    five_folds_robustness_std = 100*full_five_match_std / opt.topk
+    #mean saliency over the subjects of the full folds and of each group of folds, as plotted by plot_saliency_nii.py
+    membership = np.array([[fold in group for fold in opt.fold_idx] for group in groups], dtype=np.float64)
+    full_maps = fold_sums.sum(1) / fold_counts.sum(1)[:, None]
+    group_maps = (membership @ fold_sums) / (membership @ fold_counts[:, :, None])
+    group_sizes = np.array([len(group) for group in groups])
 
+    rows = []
     print('===='*12)
     print('===='*12)
-    print(f'one fold matches {full_one_match_mean} out of {opt.topk}. robustness: {one_folds_robustness}+{one_folds_robustness_std:.2f}%')
-    print(f'five fold matches {full_five_match_mean} out of {opt.topk}. robustness: {five_folds_robustness}+{five_folds_robustness_std:.2f}%')
+    for topk in opt.topk:
+        full_masks = topk_mask(full_maps, topk)
+        group_masks = topk_mask(group_maps, topk)
+        #number of the top k ROIs of each group found in the top k ROIs of the full map of the same experiment (num experiments x num groups)
+        matches = (group_masks & full_masks[:, None, :]).sum(-1)
+        correlation = rank_correlation(group_maps, full_maps[:, None, :])
+
+        for size in np.unique(group_sizes):
+            match = matches[:, group_sizes == size]
+            robustness = 100*match / topk
+            print(f'{size} fold matches {match.mean()} out of {topk}. robustness: {robustness.mean()}+{robustness.std():.2f}%, rank correlation: {correlation[:, group_sizes == size].mean():.4f}')
+            rows.append([topk, f'{size}_fold', match.mean(), robustness.mean(), robustness.std(), correlation[:, group_sizes == size].mean()])
+
+        #stability of the full map across the experiments, from the pairwise top k overlaps and rank correlations
+        if len(opt.expdirs) > 1:
+            pairs = np.triu_indices(len(opt.expdirs), 1)
+            overlap = (full_masks.astype(np.float64) @ full_masks.T.astype(np.float64))[pairs]
+            correlation = np.corrcoef(rank(full_maps))[pairs]
+            robustness = 100*overlap / topk
+            print(f'experiment pairs match {overlap.mean()} out of {topk}. robustness: {robustness.mean()}+{robustness.std():.2f}%, rank correlation: {correlation.mean():.4f}')
+            rows.append([topk, 'experiment_pair', overlap.mean(), robustness.mean(), robustness.std(), correlation.mean()])
     print('===='*12)
     print('===='*12)
 
+    if opt.savepath:
+        with open(opt.savepath, 'w') as f:
+            f.write('topk,comparison,matches,robustness,robustness_std,rank_correlation\n')
+            for row in rows:
+                f.write(','.join([str(item) for item in row]))
+                f.write('\n')
+
+
+def load_fold_saliency(expdir, saliency, fold_idx):
+    ###sum over the subjects and nodes of the saliency of each fold (num folds x num rois), and the number of summed rows (num folds)
+    fold_sums = []
+    fold_counts = []
+    for current_fold in fold_idx:
+        saliency_map = np.load(os.path.join(expdir, 'saliency', str(current_fold), f'{saliency}.npy'), mmap_mode='r')
+        fold_sums.append(np.asarray(saliency_map, dtype=np.float64).sum((0, 1)))
+        fold_counts.append(saliency_map.shape[0]*saliency_map.shape[1])
+    return np.stack(fold_sums), np.array(fold_counts, dtype=np.float64)
+
+
+def topk_mask(maps, topk):
+    ###boolean mask of the top k ROIs along the last axis
+    idx = np.argpartition(-maps, topk-1, axis=-1)[..., :topk]
+    mask = np.zeros(maps.shape, dtype=bool)
+    np.put_along_axis(mask, idx, True, axis=-1)
+    return mask
+
+
+def rank(maps):
+    ###ranks along the last axis, tied values share their average rank
+    return rankdata(maps, axis=-1)
 
-def count_matches(full_folds, partial_folds, topk):
-    full_fold_rois = full_folds['roi'][:topk].to_list()
-    partial_fold_rois = [fold['roi'][:topk].to_list() for fold in partial_folds]
 
-    partial_fold_counts = []
-    for rois in partial_fold_rois:
-        count = 0
-        for roi in rois:
-            if roi in full_fold_rois:
-                count += 1
-        partial_fold_counts.append(count)
-    return partial_fold_counts
+def rank_correlation(a, b):
+    ###Spearman correlation along the last axis, broadcast over the leading axes
+    a = rank(a)
+    b = rank(b)
+    a = a - a.mean(-1, keepdims=True)
+    b = b - b.mean(-1, keepdims=True)
+    return (a*b).sum(-1) / np.sqrt((a**2).sum(-1) * (b**2).sum(-1))
 
 
 if __name__=='__main__':
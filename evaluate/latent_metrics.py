@@ -0,0 +1,59 @@
+import numpy as np
+
+
+def distance_blocks(X, chunk_size=1024):
+    ###euclidean distances of chunks of rows of X to all rows (chunk size x num samples), only one block is held at a time
+    sq_norm = (X**2).sum(1)
+    for start in range(0, X.shape[0], chunk_size):
+        end = min(start+chunk_size, X.shape[0])
+        sq_dist = sq_norm[start:end, None] + sq_norm[None, :] - 2*X[start:end] @ X.T
+        np.maximum(sq_dist, 0, out=sq_dist)
+        sq_dist[np.arange(end-start), np.arange(start, end)] = 0
+        yield start, end, np.sqrt(sq_dist)
+
+
+def latent_metrics(latent, labels, chunk_size=1024):
+    '''
+        latent: latent space (num samples x latent dim)
+        labels: class of each sample (num samples), or (num samples x num targets) of which the first target is used. Samples labeled -1 (missing) are left out
+        returns dict of
+            silhouette: mean silhouette coefficient, 0 for samples alone in their class
+            davies_bouldin: Davies-Bouldin index
+            probe_accuracy: leave-one-out accuracy of the nearest class mean (linear) classifier
+    '''
+    X = np.asarray(latent, dtype=np.float64)
+    y = np.asarray(labels).reshape(X.shape[0], -1)[:, 0]
+    X = X[y >= 0]
+    y = y[y >= 0]
+    classes, y = np.unique(y, return_inverse=True)
+    one_hot = np.eye(len(classes))[y]
+    count = one_hot.sum(0)
+
+    ###silhouette from the summed distances of each sample to every class, accumulated block by block
+    silhouette = np.zeros(X.shape[0])
+    for start, end, dist in distance_blocks(X, chunk_size):
+        class_dist = dist @ one_hot
+        own = y[start:end]
+        own_count = count[own]
+        a = class_dist[np.arange(end-start), own] / np.maximum(own_count-1, 1)
+        class_dist[np.arange(end-start), own] = np.inf
+        b = (class_dist / count).min(1)
+        s = (b - a) / np.maximum(a, b)
+        silhouette[start:end] = np.where(own_count > 1, np.nan_to_num(s), 0)
+
+    ###Davies-Bouldin index from the class means
+    centroids = (one_hot.T @ X) / count[:, None]
+    scatter = np.bincount(y, weights=np.linalg.norm(X - centroids[y], axis=1), minlength=len(classes)) / count
+    centroid_dist = np.linalg.norm(centroids[:, None, :] - centroids[None], axis=2)
+    np.fill_diagonal(centroid_dist, np.inf)
+    davies_bouldin = np.mean(np.max((scatter[:, None] + scatter[None, :]) / centroid_dist, axis=1)) if len(classes) > 1 else 0.
+
+    ###leave-one-out nearest class mean: removing a sample scales its distance to its own class mean by n/(n-1)
+    sq_centroid_dist = (X**2).sum(1)[:, None] + (centroids**2).sum(1)[None, :] - 2*X @ centroids.T
+    own_count = count[y]
+    sq_centroid_dist[np.arange(X.shape[0]), y] *= (own_count / np.maximum(own_count-1, 1))**2
+    #a sample alone in its class has no class mean left
+    sq_centroid_dist[np.arange(X.shape[0])[own_count == 1], y[own_count == 1]] = np.inf
+    probe_accuracy = np.mean(sq_centroid_dist.argmin(1) == y)
+
+    return {'silhouette': float(silhouette.mean()), 'davies_bouldin': float(davies_bouldin), 'probe_accuracy': float(probe_accuracy)}
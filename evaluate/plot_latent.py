@@ -1,5 +1,7 @@
 import os
+import hashlib
 import argparse
+import multiprocessing
 import numpy as np
 import matplotlib.pyplot as plt
 
@@ -13,13 +15,17 @@ def main():
     parser.add_argument('--expdir', type=str, default='results/graph_neural_mapping', help='path to the experiment results')
     parser.add_argument('--latentdir', type=str, default='latent', help='path containing the latent_space_*.npy')
     parser.add_argument('--savedir', type=str, default='tsne', help='path to save the plotted tsne files within the expdir')
+    parser.add_argument('--cachedir', type=str, default='tsne/cache', help='path to cache the tsne embeddings within the expdir')
     parser.add_argument('--fold_idx', nargs='+', default=['0','1','2','3','4','5','6','7','8','9'], help='fold indices')
     parser.add_argument('--perplexities', type=int, nargs='+', default=[50], help='tsne perplexities')
     parser.add_argument('--random_state', type=int, default=0, help='tsne random state')
+    parser.add_argument('--cohort', action='store_true', help='also embed the latent spaces of all folds together in a single run')
+    parser.add_argument('--num_workers', type=int, default=0, help='number of processes computing the embeddings, one per cpu if 0')
 
     opt = parser.parse_args()
 
     os.makedirs(os.path.join(opt.expdir, opt.savedir), exist_ok=True)
+    os.makedirs(os.path.join(opt.expdir, opt.cachedir), exist_ok=True)
 
     latent_space_initial = []
     latent_space = []
@@ -30,18 +36,57 @@ def main():
         latent_space.append(np.load(os.path.join(opt.expdir, opt.latentdir, str(current_fold), 'latent_space.npy')))
         labels.append(np.load(os.path.join(opt.expdir, opt.latentdir, str(current_fold), 'labels.npy')))
 
+    ###(latent, label, perplexity, savename) of every plot, the embeddings are computed before plotting
+    plots = []
     for perplexity in opt.perplexities:
-        print('PLOTTING PER-FOLD LATENT SPACE PERPLEXITY: {}'.format(perplexity))
-        for idx, _ in enumerate(labels):
-            plot_tsne(latent_space_initial[idx], labels[idx], perplexity, os.path.join(opt.expdir, opt.savedir), 'initial_latent_perp{}_fold{}'.format(perplexity, idx), opt.random_state)
-            plot_tsne(latent_space[idx], labels[idx], perplexity, os.path.join(opt.expdir, opt.savedir), 'latent_perp{}_fold{}'.format(perplexity, idx), opt.random_state)
+        for idx, current_fold in enumerate(opt.fold_idx):
+            plots.append((latent_space_initial[idx], labels[idx], perplexity, 'initial_latent_perp{}_fold{}'.format(perplexity, current_fold)))
+            plots.append((latent_space[idx], labels[idx], perplexity, 'latent_perp{}_fold{}'.format(perplexity, current_fold)))
+        if opt.cohort:
+            plots.append((np.concatenate(latent_space_initial), np.concatenate(labels), perplexity, 'initial_latent_perp{}_cohort'.format(perplexity)))
+            plots.append((np.concatenate(latent_space), np.concatenate(labels), perplexity, 'latent_perp{}_cohort'.format(perplexity)))
 
+    jobs = []
+    for latent, label, perplexity, savename in plots:
+        n_components = int(target_label(label).max())+1
+        jobs.append((latent, n_components, perplexity, opt.random_state, tsne_cachepath(os.path.join(opt.expdir, opt.cachedir), latent, n_components, perplexity, opt.random_state)))
 
-def plot_tsne(latent, label, perplexity, savedir, savename, random_state=0):
-    n_samples = label.shape[0]
-    n_components = label.max()+1
+    #only the embeddings missing from the cache are computed, in parallel
+    missing = [job for job in jobs if not os.path.isfile(job[-1])]
+    print('COMPUTING {} OF {} TSNE EMBEDDINGS'.format(len(missing), len(jobs)))
+    if len(missing) > 0:
+        with multiprocessing.Pool(min(len(missing), opt.num_workers if opt.num_workers > 0 else os.cpu_count())) as pool:
+            pool.map(embed_tsne, missing, chunksize=1)
 
-    X, y = latent, label.squeeze()
+    for (latent, label, perplexity, savename), job in zip(plots, jobs):
+        print('PLOTTING {}'.format(savename))
+        plot_tsne(np.load(job[-1]), label, os.path.join(opt.expdir, opt.savedir), savename)
+
+
+def target_label(label):
+    ###labels of the first target
+    return label.reshape(label.shape[0], -1)[:, 0]
+
+
+def tsne_cachepath(cachedir, latent, n_components, perplexity, random_state):
+    ###cache file keyed by the tsne parameters and a hash of the latent space
+    h = hashlib.sha1(np.ascontiguousarray(latent).tobytes())
+    h.update('{}_{}_{}'.format(latent.shape, latent.dtype, n_components).encode())
+    return os.path.join(cachedir, 'tsne_perp{}_rs{}_{}.npy'.format(perplexity, random_state, h.hexdigest()))
+
+
+def embed_tsne(job):
+    latent, n_components, perplexity, random_state, cachepath = job
+    tsne = manifold.TSNE(n_components=n_components, init='random',
+                         random_state=random_state, perplexity=perplexity)
+    Y = tsne.fit_transform(latent)
+    #written under a temporary name and renamed, so that an interrupted run is never read from the cache
+    np.save(cachepath + '.tmp.npy', Y)
+    os.replace(cachepath + '.tmp.npy', cachepath)
+
+
+def plot_tsne(Y, label, savedir, savename):
+    y = target_label(label)
 
     female = y == 0
     male = y == 1
@@ -49,9 +94,6 @@ def plot_tsne(latent, label, perplexity, savedir, savename, random_state=0):
     fig, ax = plt.subplots()
     fig.set_size_inches((8,8))
     ax.axis('off')
-    tsne = manifold.TSNE(n_components=n_components, init='random',
-                         random_state=random_state, perplexity=perplexity)
-    Y = tsne.fit_transform(X)
     plt.scatter(Y[female, 0], Y[female, 1], c="r", s=1000, linewidth=3, edgecolors='black')
     plt.scatter(Y[male, 0], Y[male, 1], c="b", s=1000, linewidth=3, edgecolors='black')
     plt.axis('tight')
@@ -4,6 +4,7 @@ import numpy as np
 import pandas as pd
 import nibabel as nib
 import nilearn as nil
+import nilearn.image
 
 
 def main():
@@ -34,100 +35,78 @@ def main():
         saliency0.append(np.load(os.path.join(opt.expdir, 'saliency', str(current_fold), 'saliency_female.npy')))
         saliency1.append(np.load(os.path.join(opt.expdir, 'saliency', str(current_fold), 'saliency_male.npy')))
 
-    saliency0 = np.mean(np.concatenate(saliency0, 0), axis=1)
-    saliency1 = np.mean(np.concatenate(saliency1, 0), axis=1)
+    #saliency of each ROI averaged over the subjects, voxel volumes are produced only when they are saved
+    saliency0 = np.mean(np.concatenate(saliency0, 0), axis=(0, 1))
+    saliency1 = np.mean(np.concatenate(saliency1, 0), axis=(0, 1))
+    roiimgindex = roiimgarray.astype(np.int64)
 
-    saliency0subjects = []
-    saliency1subjects = []
+    plot_nii(roi_lut(saliency0, roiimgindex), opt.topk, roiimgaffine, roiimgindex, roimeta, os.path.join(opt.expdir, opt.savedir), 'female')
+    plot_nii(roi_lut(saliency1, roiimgindex), opt.topk, roiimgaffine, roiimgindex, roimeta, os.path.join(opt.expdir, opt.savedir), 'male')
 
-    for subjidx, (sal0, sal1) in enumerate(zip(saliency0, saliency1)):
-        saliency0array = roiimgarray.copy()
-        saliency1array = roiimgarray.copy()
-        print("EXTRACTING SALIENCY SUBJECT: {}".format(subjidx))
-        for i, (s0, s1) in enumerate(zip(sal0, sal1)):
-            roi_voxel_idx = np.where(roiimgarray==i+1)
-            for j in range(roi_voxel_idx[0].shape[0]):
-                saliency0array[roi_voxel_idx[0][j], roi_voxel_idx[1][j], roi_voxel_idx[2][j]] = s0
-                saliency1array[roi_voxel_idx[0][j], roi_voxel_idx[1][j], roi_voxel_idx[2][j]] = s1
 
-        saliency0subjects.append(saliency0array)
-        saliency1subjects.append(saliency1array)
+def roi_lut(roi_values, roiimgindex):
+    ###lookup table from the ROI id to its value: ROI i+1 takes roi_values[i], the background (0) stays 0
+    lut = np.arange(max(roiimgindex.max(), len(roi_values)) + 1, dtype=np.float64)
+    lut[1:len(roi_values)+1] = roi_values
+    return lut
 
-    plot_nii(saliency0subjects, opt.topk, roiimgaffine, roiimgarray, roimeta, os.path.join(opt.expdir, opt.savedir), 'female')
-    plot_nii(saliency1subjects, opt.topk, roiimgaffine, roiimgarray, roimeta, os.path.join(opt.expdir, opt.savedir), 'male')
 
+def save_nii(lut, roiimgindex, roiimgaffine, path):
+    ###voxel volume of the ROI values, indexed from the lookup table with the ROI image
+    nib.save(nib.Nifti1Image(lut[roiimgindex], roiimgaffine), path)
 
-def plot_nii(subject_list, topk, roiimgaffine, roiimgarray, roimeta, savepath, desc):
-    saliency_array = np.mean(np.stack(subject_list), axis=0)
 
-    saliency_array_normalized = saliency_array.copy()
-    saliency_array_normalized -= saliency_array_normalized.min()
-    saliency_array_normalized /= saliency_array_normalized.max()
+def plot_nii(saliency_lut, topk, roiimgaffine, roiimgindex, roimeta, savepath, desc):
+    #ROI ids found in the ROI image, the normalization and top-k are taken over the values of the volume
+    present = np.bincount(roiimgindex.ravel(), minlength=len(saliency_lut)) > 0
+
+    saliency_lut_normalized = saliency_lut.copy()
+    saliency_lut_normalized -= saliency_lut_normalized[present].min()
+    saliency_lut_normalized /= saliency_lut_normalized[present].max()
 
     if topk:
-        values = np.unique(saliency_array_normalized)
+        values = np.unique(saliency_lut_normalized[present])
         topk_idx = np.argsort(values)[-topk]
         topk_value = values[topk_idx]
-        saliency_array_normalized_topk = saliency_array_normalized.copy()
-        saliency_array_normalized_topk[saliency_array_normalized_topk<topk_value]=0.0
-        saliency_img_normalized_topk = nib.Nifti1Image(saliency_array_normalized_topk, roiimgaffine)
-
-        nib.save(saliency_img_normalized_topk, os.path.join(savepath, 'saliency_{}_top{}.nii'.format(desc, topk)))
-
-        saliency_values = np.unique(saliency_array_normalized_topk)
-
-        network_dicts = {'Vis':{'LH': np.zeros_like(saliency_array), 'RH': np.zeros_like(saliency_array)}, 'SomMot':{'LH': np.zeros_like(saliency_array), 'RH': np.zeros_like(saliency_array)}, 'DorsAttn':{'LH': np.zeros_like(saliency_array), 'RH': np.zeros_like(saliency_array)}, 'SalVentAttn':{'LH': np.zeros_like(saliency_array), 'RH': np.zeros_like(saliency_array)}, 'Limbic':{'LH': np.zeros_like(saliency_array), 'RH': np.zeros_like(saliency_array)}, 'Cont':{'LH': np.zeros_like(saliency_array), 'RH': np.zeros_like(saliency_array)}, 'Default':{'LH': np.zeros_like(saliency_array), 'RH': np.zeros_like(saliency_array)}}
-        for value in saliency_values:
-            if value==0.0: continue
-            roi_array = saliency_array_normalized_topk.copy()
-            roi_array[saliency_array_normalized_topk!=value] = 0.0
-            idx_tuple = np.nonzero(roi_array)
-            roi_id = roiimgarray[idx_tuple[0][0], idx_tuple[1][0], idx_tuple[2][0]]
+        saliency_lut_normalized_topk = saliency_lut_normalized.copy()
+        saliency_lut_normalized_topk[saliency_lut_normalized_topk<topk_value]=0.0
+        save_nii(saliency_lut_normalized_topk, roiimgindex, roiimgaffine, os.path.join(savepath, 'saliency_{}_top{}.nii'.format(desc, topk)))
+
+        #top-k ROIs grouped by the Yeo network and hemisphere of their label
+        network_dicts = {key: {'LH': np.zeros_like(saliency_lut), 'RH': np.zeros_like(saliency_lut)} for key in ['Vis', 'SomMot', 'DorsAttn', 'SalVentAttn', 'Limbic', 'Cont', 'Default']}
+        for roi_id in np.nonzero(present & (saliency_lut_normalized_topk != 0.0))[0]:
+            if roi_id==0: continue
             roi_network = roimeta[1][roi_id]
             for key in network_dicts.keys():
                 if key in roi_network:
                     if 'LH' in roi_network:
-                        network_dicts[key]['LH'] += roi_array
+                        network_dicts[key]['LH'][roi_id] = saliency_lut_normalized_topk[roi_id]
                     elif 'RH' in roi_network:
-                        network_dicts[key]['RH'] += roi_array
+                        network_dicts[key]['RH'][roi_id] = saliency_lut_normalized_topk[roi_id]
                     else:
                         print('ERROR IDENTIFYING HEMISPHERE INFORMATION')
         for key in network_dicts.keys():
-            network_lh_img = nib.Nifti1Image(network_dicts[key]['LH'], roiimgaffine)
-            nib.save(network_lh_img, os.path.join(savepath, 'network', 'saliency_{}_top{}_{}_lh'.format(desc, topk, key)))
-            network_rh_img = nib.Nifti1Image(network_dicts[key]['RH'], roiimgaffine)
-            nib.save(network_rh_img, os.path.join(savepath, 'network', 'saliency_{}_top{}_{}_rh'.format(desc, topk, key)))
-
-    saliency_img_normalized = nib.Nifti1Image(saliency_array_normalized, roiimgaffine)
-    nib.save(saliency_img_normalized, os.path.join(savepath, 'saliency_{}.nii'.format(desc)))
-
-
-def write_csv(normalized_array, roiimgarray, roimeta, savepath, desc, threshold=None):
-    if threshold:
-        normalized_idx = (normalized_array>threshold).astype(np.uint8)
-    else:
-        normalized_idx = (roiimgarray!=0).astype(np.uint8)
-    idx_tuple = np.nonzero(normalized_idx)
-    rois = []
-    values = []
-    abs_values = []
-    labels = []
-    for i in range(len(idx_tuple[0])):
-        roi = roiimgarray[idx_tuple[0][i],idx_tuple[1][i],idx_tuple[2][i]]
-        value = normalized_array[idx_tuple[0][i],idx_tuple[1][i],idx_tuple[2][i]]
-        if str(roi) not in rois:
-            assert value not in values
-            rois.append(str(roi))
-            values.append(str(value))
-            abs_values.append(str(abs(value)))
-            labels.append(str(roimeta[1][roi]))
-    zipped = list(zip(abs_values, rois, labels, values))
-    zipped.sort(reverse=True)
+            save_nii(network_dicts[key]['LH'], roiimgindex, roiimgaffine, os.path.join(savepath, 'network', 'saliency_{}_top{}_{}_lh.nii'.format(desc, topk, key)))
+            save_nii(network_dicts[key]['RH'], roiimgindex, roiimgaffine, os.path.join(savepath, 'network', 'saliency_{}_top{}_{}_rh.nii'.format(desc, topk, key)))
+        write_csv(saliency_lut_normalized_topk, present, roimeta, savepath, '{}_top{}'.format(desc, topk), threshold=0.0)
+
+    save_nii(saliency_lut_normalized, roiimgindex, roiimgaffine, os.path.join(savepath, 'saliency_{}.nii'.format(desc)))
+    write_csv(saliency_lut_normalized, present, roimeta, savepath, desc)
+
+
+def write_csv(normalized_lut, present, roimeta, savepath, desc, threshold=None):
+    ###ROIs of the image (with values above threshold if given) sorted by the absolute value
+    roi_ids = np.nonzero(present)[0]
+    roi_ids = roi_ids[roi_ids!=0]
+    if threshold is not None:
+        roi_ids = roi_ids[normalized_lut[roi_ids]>threshold]
+    roi_ids = roi_ids[np.argsort(-np.abs(normalized_lut[roi_ids]), kind='stable')]
 
     with open(os.path.join(savepath, 'description', 'saliency_{}.csv'.format(desc)), 'w') as f:
         f.write('abs_value,roi,label,value\n')
-        for item in zipped:
-            f.write(','.join(item))
+        for roi_id in roi_ids:
+            value = normalized_lut[roi_id]
+            f.write(','.join([str(abs(value)), str(roi_id), str(roimeta[1][roi_id]), str(value)]))
             f.write('\n')
 
 
@@ -7,32 +7,35 @@ import torch.nn as nn
 import torch.optim as optim
 
 from models.graphcnn import *
+#imported as the top-level module batch, like in models/graphcnn.py, so that GraphBatch is a single class
+from batch import graph_loader
 from util import load_data, separate_data
+from evaluate.latent_metrics import latent_metrics
 from tqdm import tqdm
 from sklearn import metrics
 from torch.utils.tensorboard import SummaryWriter
 
 
-c_criterion = nn.CrossEntropyLoss()
+#graphs with a missing target value are labeled -1
+c_criterion = nn.CrossEntropyLoss(ignore_index=-1)
 d_criterion = nn.BCEWithLogitsLoss()
 
-def train(args, model, device, train_graphs, optimizer, beta, epoch):
+def train(args, model, device, train_loader, optimizer, beta, epoch):
     model.train()
 
-    num_rois = train_graphs[0].node_features.shape[1]
-    total_iters = args.iters_per_epoch
+    total_iters = len(train_loader)
     loss_accum = 0
-    for pos in range(total_iters):
-        selected_idx = np.random.permutation(len(train_graphs))[:args.batch_size]
+    for batch in train_loader:
+        batch = batch.to(device, non_blocking=True)
+        c_logit, d_logit = model(batch)
 
-        batch_graph = [train_graphs[idx] for idx in selected_idx]
-        c_logit, d_logit = model(batch_graph)
-
-        c_labels = torch.LongTensor([graph.label for graph in batch_graph]).to(device)
-        d_labels = torch.cat([torch.ones(args.batch_size*num_rois, 1), torch.zeros(args.batch_size*num_rois, 1)], 0).to(device)
+        c_labels = batch.labels.view(len(batch), -1)
+        num_nodes = batch.node_features.shape[0]
+        d_labels = torch.cat([torch.ones(num_nodes, 1), torch.zeros(num_nodes, 1)], 0).to(device)
 
         d_loss = d_criterion(d_logit, d_labels)
-        c_loss = c_criterion(c_logit, c_labels)
+        #classification loss summed over the targets, skipping targets missing from every graph of the minibatch
+        c_loss = sum([c_criterion(logit, c_labels[:, target]) for target, logit in enumerate(model.split_logits(c_logit)) if (c_labels[:, target] >= 0).any()])
 
         loss = c_loss + beta*d_loss
 
@@ -46,66 +49,91 @@ def train(args, model, device, train_graphs, optimizer, beta, epoch):
     average_loss = loss_accum/total_iters
     return average_loss
 
-def pass_data_iteratively(model, graphs):
+def pass_data_iteratively(model, store, batch_size):
     model.eval()
     c_logit_list = []
-    d_logit_list = []
-    for g in graphs:
-        c_logit, d_logit = model([g])
-        c_logit_list.append(c_logit.detach())
-        d_logit_list.append(d_logit)
-    return torch.cat(c_logit_list, 0), torch.cat(d_logit_list, 0)
+    with torch.no_grad():
+        for start in range(0, len(store), batch_size):
+            c_logit, _ = model(store.batch(range(start, min(start+batch_size, len(store)))), discriminator=False)
+            c_logit_list.append(c_logit)
+    return torch.cat(c_logit_list, 0)
 
 
-def get_saliency_map(model, graphs, cls):
+def get_saliency_map(model, store, classes, batch_size):
+    ###saliency maps (num graphs x num nodes x input dim) of each class, computed from one forward pass per minibatch
     model.eval()
     saliency_maps = []
-    for graph in graphs:
-        saliency_map = model.compute_saliency([graph], cls)
-        saliency_maps.append(saliency_map.detach().cpu().numpy())
+    for start in range(0, len(store), batch_size):
+        batch = store.batch(range(start, min(start+batch_size, len(store))))
+        saliency_map = model.compute_saliency(batch, classes)
+        saliency_maps.append(saliency_map.view(len(classes), len(batch), -1, saliency_map.shape[-1]).detach().cpu().numpy())
 
-    saliency_maps = np.stack(saliency_maps, axis=0)
+    saliency_maps = np.concatenate(saliency_maps, axis=1)
     return saliency_maps
 
 
-def get_latent_space(model, graphs):
+def get_latent_space(model, store, batch_size):
     model.eval()
     output_list = []
-    label_list = []
-    for g in graphs:
-        latent = model([g], latent=True)
-        label = np.array([g.label])
-        output_list.append(latent)
-        label_list.append(label)
+    with torch.no_grad():
+        for start in range(0, len(store), batch_size):
+            latent = model(store.batch(range(start, min(start+batch_size, len(store)))), latent=True)
+            output_list.append(latent)
     latent_space = np.concatenate(output_list, axis=0)
-    labels = np.stack(label_list, axis=0)
+    labels = store.labels.cpu().numpy().reshape(len(store), -1)
     return latent_space, labels
 
 
-def test(args, model, device, graphs):
+def test(args, model, device, store):
+    ###accuracy, precision and recall lists over the targets, macro averaged for targets of more than two classes
+    ###graphs with a missing target value (-1) are left out of the metrics of that target, which are nan if all are missing
     model.eval()
-    output, _ = pass_data_iteratively(model, graphs)
-    labels = torch.LongTensor([graph.label for graph in graphs]).to(device)
-
-    pred = output.max(1, keepdim=True)[1]
-    pred = pred.detach().cpu().numpy()
-    labels = labels.detach().cpu().numpy()
-    accuracy = metrics.accuracy_score(labels, pred)
-    precision = metrics.precision_score(labels, pred)
-    recall = metrics.recall_score(labels, pred)
+    output = pass_data_iteratively(model, store, args.eval_batch_size)
+    labels = store.labels.view(len(store), -1).detach().cpu().numpy()
+
+    accuracy, precision, recall = [], [], []
+    for target, logit in enumerate(model.split_logits(output)):
+        pred = logit.max(1, keepdim=True)[1]
+        pred = pred.detach().cpu().numpy()
+        valid = labels[:, target] >= 0
+        if not valid.any():
+            accuracy.append(float('nan'))
+            precision.append(float('nan'))
+            recall.append(float('nan'))
+            continue
+        average = 'binary' if logit.shape[1] == 2 else 'macro'
+        accuracy.append(metrics.accuracy_score(labels[valid, target], pred[valid]))
+        precision.append(metrics.precision_score(labels[valid, target], pred[valid], average=average))
+        recall.append(metrics.recall_score(labels[valid, target], pred[valid], average=average))
     return accuracy, precision, recall
 
 
-def main():
+def add_metrics(summary_writer, targets, accuracy, precision, recall, epoch):
+    for target, acc, prec, rec in zip(targets, accuracy, precision, recall):
+        prefix = 'metrics' if len(targets) == 1 else 'metrics/{}'.format(target)
+        summary_writer.add_scalar('{}/accuracy'.format(prefix), acc, epoch)
+        summary_writer.add_scalar('{}/precision'.format(prefix), prec, epoch)
+        summary_writer.add_scalar('{}/recall'.format(prefix), rec, epoch)
+
+
+def get_parser():
     # Training settings
     # Note: Hyper-parameters need to be tuned in order to obtain results reported in the paper.
     parser = argparse.ArgumentParser(description='PyTorch GIN fMRI')
     parser.add_argument('--device', type=int, default=0, help='which gpu to use if any')
     parser.add_argument('--sourcedir', type=str, default='data', help='path to the data directory')
+    parser.add_argument('--cachedir', type=str, default=None, help='path to cache the preprocessed graphs, not cached if not given')
+    parser.add_argument('--num_workers', type=int, default=0, help='number of processes for loading the subjects, loaded in the main process if 0')
     parser.add_argument('--sparsity', type=int, default=30, help='sparsity M of graph adjacency')
-    parser.add_argument('--input_feature', type=str, default='one_hot', help='input feature type', choices=['one_hot', 'coordinate', 'mean_bold'])
+    parser.add_argument('--edge_weight', type=str, default='binary', choices=['binary', 'float16', 'float32'], help='binary adjacency, or connectivity values of the edges stored as float16 or float32 and used in the sum and average neighbor pooling')
+    parser.add_argument('--targets', type=str, nargs='+', default=['Gender'], help='behavioral columns to classify, several targets are predicted by heads on shared GIN layers')
+    parser.add_argument('--input_feature', type=str, default='one_hot', help='input feature type', choices=['one_hot', 'coordinate', 'mean_bold', 'moments_bold'])
+    parser.add_argument('--connectivity', type=str, default='precomputed', choices=['precomputed', 'timeseries'], help='precomputed connectivity matrices, or Pearson correlation computed from the streamed timeseries')
     parser.add_argument('--batch_size', type=int, default=32, help='input minibatch size for training')
+    parser.add_argument('--eval_batch_size', type=int, default=64, help='minibatch size for evaluation')
     parser.add_argument('--iters_per_epoch', type=int, default=50, help='number of iterations per each epoch')
+    parser.add_argument('--sampling', type=str, default='random', choices=['random', 'epoch'], help='random subset of graphs for each of the iters_per_epoch minibatches, or one shuffled pass over all training graphs per epoch')
+    parser.add_argument('--loader_workers', type=int, default=0, help='number of processes prefetching the training minibatches, assembled in the main process if 0')
     parser.add_argument('--epochs', type=int, default=150, help='number of epochs to train')
     parser.add_argument('--lr', type=float, default=0.005, help='initial learning rate')
     parser.add_argument('--lr_step', type=int, default=5, help='learning rate decay step')
@@ -119,12 +147,17 @@ def main():
     parser.add_argument('--final_dropout', type=float, default=0.5, help='final layer dropout')
     parser.add_argument('--graph_pooling_type', type=str, default="sum", choices=["sum", "average"], help='Pooling for over nodes in a graph: sum or average')
     parser.add_argument('--neighbor_pooling_type', type=str, default="sum", choices=["sum", "average", "max"], help='Pooling for over neighboring nodes: sum, average or max')
+    parser.add_argument('--max_aggregation', type=str, default="padded", choices=["padded", "scatter"], help='max neighbor pooling over gathered padded neighbor lists, or scatter max over the edges')
+    parser.add_argument('--adjacency', type=str, default="sparse", choices=["sparse", "dense"], help='minibatch adjacency: block diagonal sparse matrix, or dense tensor of graphs with the same number of nodes')
     parser.add_argument('--learn_eps', action="store_true", help='whether to learn the epsilon weighting for the center nodes. Does not affect training accuracy though.')
+    parser.add_argument('--latent_metrics', action="store_true", help='log the silhouette score, Davies-Bouldin index and probe accuracy of the test latent space at every epoch')
     parser.add_argument('--exp', type = str, default = "graph_neural_mapping", help='experiment name')
-    args = parser.parse_args()
+    return parser
+
 
+def run_fold(args, graphs, num_classes):
+    ###train and evaluate on the fold args.fold_idx, results are written to results/{exp}
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-    graphs, num_classes = load_data(args.sourcedir, args.sparsity, args.input_feature)
 
     os.makedirs('results/{}/saliency/{}'.format(args.exp, args.fold_idx), exist_ok=True)
     os.makedirs('results/{}/latent/{}'.format(args.exp, args.fold_idx), exist_ok=True)
@@ -132,7 +165,11 @@ def main():
 
     train_graphs, test_graphs = separate_data(graphs, args.fold_seed, args.fold_idx)
 
-    model = GIN_InfoMaxReg(args.num_layers, args.num_mlp_layers, train_graphs[0].node_features.shape[1], args.hidden_dim, num_classes, args.final_dropout, args.learn_eps, args.graph_pooling_type, args.neighbor_pooling_type, device).to(device)
+    model = GIN_InfoMaxReg(args.num_layers, args.num_mlp_layers, train_graphs[0].node_features.shape[1], args.hidden_dim, num_classes, args.final_dropout, args.learn_eps, args.graph_pooling_type, args.neighbor_pooling_type, device, args.adjacency=='dense', args.max_aggregation).to(device)
+    #minibatches are assembled on the cpu by the loader workers, or directly on the device without workers
+    train_store = model.graph_store(train_graphs, torch.device('cpu') if args.loader_workers > 0 else device)
+    train_loader = graph_loader(train_store, args.batch_size, args.iters_per_epoch, args.sampling, args.loader_workers, args.loader_workers > 0 and device.type == 'cuda')
+    test_store = model.graph_store(test_graphs)
     optimizer = optim.Adam(model.parameters(), lr=args.lr)
     scheduler = optim.lr_scheduler.StepLR(optimizer, step_size=args.lr_step, gamma=args.lr_rate)
 
@@ -142,34 +179,46 @@ def main():
         writer = csv.writer(f)
         writer.writerows(vars(args).items())
 
-    latent_space_initial, labels = get_latent_space(model, test_graphs)
+    latent_space_initial, labels = get_latent_space(model, test_store, args.eval_batch_size)
     np.save('results/{}/latent/{}/latent_space_initial.npy'.format(args.exp, args.fold_idx), latent_space_initial)
     np.save('results/{}/latent/{}/labels.npy'.format(args.exp, args.fold_idx), labels)
     del latent_space_initial
     del labels
 
     for epoch in tqdm(range(args.epochs), ncols=50, desc=f'{args.fold_idx}'):
-        loss_train = train(args, model, device, train_graphs, optimizer, args.beta, epoch)
+        loss_train = train(args, model, device, train_loader, optimizer, args.beta, epoch)
         scheduler.step()
-        acc_train, precision_train, recall_train = test(args, model, device, train_graphs)
+        acc_train, precision_train, recall_train = test(args, model, device, train_store)
 
         train_summary_writer.add_scalar('loss/total', loss_train, epoch)
-        train_summary_writer.add_scalar('metrics/accuracy', acc_train, epoch)
-        train_summary_writer.add_scalar('metrics/precision', precision_train, epoch)
-        train_summary_writer.add_scalar('metrics/recall', recall_train, epoch)
+        add_metrics(train_summary_writer, args.targets, acc_train, precision_train, recall_train, epoch)
 
-    acc_test, precision_test, recall_test = test(args, model, device, test_graphs)
-    test_summary_writer.add_scalar('metrics/accuracy', acc_test, epoch)
-    test_summary_writer.add_scalar('metrics/precision', precision_test, epoch)
-    test_summary_writer.add_scalar('metrics/recall', recall_test, epoch)
+        if args.latent_metrics:
+            latent_space, labels = get_latent_space(model, test_store, args.eval_batch_size)
+            for name, value in latent_metrics(latent_space, labels).items():
+                test_summary_writer.add_scalar('latent/{}'.format(name), value, epoch)
+
+    acc_test, precision_test, recall_test = test(args, model, device, test_store)
+    add_metrics(test_summary_writer, args.targets, acc_test, precision_test, recall_test, epoch)
 
     torch.save(model.state_dict(), 'results/{}/model/{}/model.pt'.format(args.exp, args.fold_idx))
-    latent_space, labels = get_latent_space(model, test_graphs)
-    saliency_map_0 = get_saliency_map(model, test_graphs, 0)
-    saliency_map_1 = get_saliency_map(model, test_graphs, 1)
+    latent_space, labels = get_latent_space(model, test_store, args.eval_batch_size)
     np.save('results/{}/latent/{}/latent_space.npy'.format(args.exp, args.fold_idx), latent_space)
-    np.save('results/{}/saliency/{}/saliency_female.npy'.format(args.exp, args.fold_idx), saliency_map_0)
-    np.save('results/{}/saliency/{}/saliency_male.npy'.format(args.exp, args.fold_idx), saliency_map_1)
+    #saliency of each class of each target, the classes of a target are consecutive columns of the logits
+    class_start = np.cumsum([0] + model.output_dims)
+    for target, start, end in zip(args.targets, class_start[:-1], class_start[1:]):
+        saliency_maps = get_saliency_map(model, test_store, list(range(start, end)), args.eval_batch_size)
+        if target == 'Gender':
+            np.save('results/{}/saliency/{}/saliency_female.npy'.format(args.exp, args.fold_idx), saliency_maps[0])
+            np.save('results/{}/saliency/{}/saliency_male.npy'.format(args.exp, args.fold_idx), saliency_maps[1])
+        else:
+            np.save('results/{}/saliency/{}/saliency_{}.npy'.format(args.exp, args.fold_idx, target), saliency_maps)
+
+
+def main():
+    args = get_parser().parse_args()
+    graphs, num_classes = load_data(args.sourcedir, args.sparsity, args.input_feature, args.cachedir, args.num_workers, args.edge_weight, args.targets, args.connectivity)
+    run_fold(args, graphs, num_classes)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,219 @@
+import numpy as np
+import torch
+from torch.utils.data import DataLoader, Sampler
+
+
+class GraphBatch(object):
+    def __init__(self, node_features, Adj_block, graph_pool, labels, graph_index, padded_neighbor_list=None):
+        '''
+            node_features: node features of all graphs concatenated (num nodes x input dim), or the index of the nonzero one-hot feature of each node (num nodes)
+            Adj_block: block diagonal sparse adjacency (num nodes x num nodes), or dense adjacency (num graphs x nodes per graph x nodes per graph). None for max neighbor pooling
+            graph_pool: sparse sum or average pooling matrix (num graphs x num nodes), None for dense minibatches
+            labels: graph labels (num graphs)
+            graph_index: index of the graph each node belongs to (num nodes)
+            padded_neighbor_list: for max neighbor pooling, padded neighbor indices (num nodes x max degree) with -1 as padding, or (center, neighbor) indices of all edges (2 x num edges) for the scatter max aggregation
+        '''
+
+        self.node_features = node_features
+        self.Adj_block = Adj_block
+        self.graph_pool = graph_pool
+        self.labels = labels
+        self.graph_index = graph_index
+        self.padded_neighbor_list = padded_neighbor_list
+
+    def __len__(self):
+        return len(self.labels)
+
+    def to(self, device, non_blocking=False):
+        for key, value in vars(self).items():
+            if torch.is_tensor(value):
+                setattr(self, key, value.to(device, non_blocking=non_blocking))
+        return self
+
+    def pin_memory(self):
+        ###called by the DataLoader when pin_memory is set
+        for key, value in vars(self).items():
+            if torch.is_tensor(value):
+                setattr(self, key, value.pin_memory())
+        return self
+
+
+class GraphStore(object):
+    def __init__(self, graphs, learn_eps, graph_pooling_type, neighbor_pooling_type, device=torch.device('cpu'), dense=False, max_aggregation="padded", categorical=False):
+        '''
+            graphs: list of S2VGraph, the values of the adjacency are taken from graph.edge_weight if it is set
+            learn_eps: If False, self-loops are stored in the adjacency
+            graph_pooling_type: how to aggregate entire nodes in a graph (sum, average)
+            neighbor_pooling_type: how to aggregate neighbors (sum, average, or max)
+            device: device to keep the stored tensors and to assemble the minibatches on
+            dense: If True, minibatches hold a dense (num graphs x nodes per graph x nodes per graph) adjacency. All graphs must have the same number of nodes.
+            max_aggregation: neighbor indices for max neighbor pooling (padded, scatter)
+            categorical: If True, one-hot node features are stored and batched as the index of the nonzero feature (num nodes). Not used with max neighbor pooling.
+        '''
+
+        self.learn_eps = learn_eps
+        self.graph_pooling_type = graph_pooling_type
+        self.neighbor_pooling_type = neighbor_pooling_type
+        self.device = device
+        self.dense = dense
+        self.max_aggregation = max_aggregation
+
+        ###contiguous node features, labels and row-sorted edges (CSR) of all graphs
+        self.num_nodes = torch.LongTensor([len(graph.node_features) for graph in graphs])
+        self.node_start = exclusive_cumsum(self.num_nodes)
+        #node features shared by all graphs (same tensor object) are kept once and indexed by the node index within each graph
+        self.shared_features = all([graph.node_features is graphs[0].node_features for graph in graphs])
+        if self.shared_features:
+            node_features = graphs[0].node_features
+        else:
+            node_features = torch.cat([graph.node_features for graph in graphs], 0)
+        self.categorical = categorical and not neighbor_pooling_type == "max" and is_one_hot(node_features)
+        if self.categorical:
+            node_features = node_features.argmax(1)
+        self.node_features = node_features.to(device)
+        self.labels = torch.LongTensor([graph.label for graph in graphs]).to(device)
+
+        degree_list = []
+        col_list = []
+        value_list = []
+        for graph in graphs:
+            num_node = len(graph.node_features)
+            edge_mat = graph.edge_mat
+            #edge weights are the values of the sum and average aggregation, the max pooling ignores them
+            value = torch.ones(edge_mat.shape[1]) if graph.edge_weight is None else graph.edge_weight.float()
+            #Add self-loops in the adjacency matrix if learn_eps is False, i.e., aggregate center nodes and neighbor nodes altogether.
+            #Center nodes of the max pooling are added when the minibatch is assembled
+            if not learn_eps and not neighbor_pooling_type == "max":
+                edge_mat = torch.cat([edge_mat, torch.arange(num_node).repeat(2, 1)], 1)
+                value = torch.cat([value, torch.ones(num_node)])
+            order = torch.argsort(edge_mat[0]*num_node + edge_mat[1])
+            edge_mat = edge_mat[:, order]
+            degree_list.append(torch.bincount(edge_mat[0], minlength=num_node))
+            col_list.append(edge_mat[1])
+            value_list.append(value[order])
+        self.num_edges = torch.LongTensor([len(col) for col in col_list])
+        if dense and not (self.num_nodes==self.num_nodes[0]).all():
+            raise ValueError("dense minibatches require the same number of nodes in all graphs")
+        self.edge_start = exclusive_cumsum(self.num_edges)
+        self.degree = torch.cat(degree_list).to(device)
+        self.col = torch.cat(col_list).to(device)
+        self.value = torch.cat(value_list).to(device)
+
+    def __len__(self):
+        return len(self.num_nodes)
+
+    def batch(self, idx=None):
+        ###assemble the minibatch of graphs idx with vectorized offsets, all graphs if idx is None
+        if idx is None:
+            idx = torch.arange(len(self.num_nodes))
+        idx = torch.as_tensor(idx, dtype=torch.long)
+        num_nodes = self.num_nodes[idx]
+        num_edges = self.num_edges[idx]
+        node_start = exclusive_cumsum(num_nodes)
+        total_nodes = int(num_nodes.sum())
+
+        node_idx = concat_ranges(self.node_start[idx], num_nodes).to(self.device)
+        edge_idx = concat_ranges(self.edge_start[idx], num_edges).to(self.device)
+
+        Adj_block = None
+        graph_pool = None
+        if self.dense:
+            ###dense adjacency of each graph, the graph pooling is a reshape-sum in the model
+            if not self.neighbor_pooling_type == "max":
+                num_node = int(num_nodes[0])
+                graph_idx = torch.repeat_interleave(torch.arange(len(idx), device=self.device), num_edges.to(self.device))
+                row = torch.repeat_interleave(torch.arange(total_nodes, device=self.device), self.degree[node_idx]) % num_node
+                Adj_block = torch.zeros(len(idx), num_node, num_node, device=self.device)
+                Adj_block[graph_idx, row, self.col[edge_idx]] = self.value[edge_idx]
+        else:
+            ###block diagonal adjacency: columns are shifted by the start of each graph in the minibatch
+            if not self.neighbor_pooling_type == "max":
+                crow = torch.cat([torch.zeros(1, dtype=torch.long, device=self.device), torch.cumsum(self.degree[node_idx], 0)])
+                col = self.col[edge_idx] + torch.repeat_interleave(node_start, num_edges).to(self.device)
+                Adj_block = sparse_matrix(crow, col, self.value[edge_idx], (total_nodes, total_nodes))
+
+            ###sum or average pooling over entire nodes in each graph (num graphs x num nodes)
+            if self.graph_pooling_type == "average":
+                elem = torch.repeat_interleave(1./num_nodes.float(), num_nodes).to(self.device)
+            else:
+                elem = torch.ones(total_nodes, device=self.device)
+            crow = torch.cat([node_start, num_nodes.sum().view(1)]).to(self.device)
+            graph_pool = sparse_matrix(crow, torch.arange(total_nodes, device=self.device), elem, (len(idx), total_nodes))
+
+        padded_neighbor_list = None
+        if self.neighbor_pooling_type == "max":
+            degree = self.degree[node_idx]
+            row = torch.repeat_interleave(torch.arange(total_nodes, device=self.device), degree)
+            col = self.col[edge_idx] + torch.repeat_interleave(node_start, num_edges).to(self.device)
+            if self.max_aggregation == "scatter":
+                padded_neighbor_list = torch.stack([row, col])
+                if not self.learn_eps:
+                    padded_neighbor_list = torch.cat([padded_neighbor_list, torch.arange(total_nodes, device=self.device).repeat(2, 1)], 1)
+            else:
+                ###scatter the neighbors of each node into a row padded with -1 (dummy data)
+                position = torch.arange(len(col), device=self.device) - torch.repeat_interleave(torch.cumsum(degree, 0) - degree, degree)
+                max_deg = int(degree.max())
+                padded_neighbor_list = torch.full((total_nodes, max_deg if self.learn_eps else max_deg+1), -1, dtype=torch.long, device=self.device)
+                padded_neighbor_list[row, position] = col
+                #Add center nodes in the maxpooling if learn_eps is False, i.e., aggregate center nodes and neighbor nodes altogether.
+                if not self.learn_eps:
+                    padded_neighbor_list[:, -1] = torch.arange(total_nodes, device=self.device)
+
+        graph_index = torch.repeat_interleave(torch.arange(len(idx), device=self.device), num_nodes.to(self.device))
+        if self.shared_features:
+            node_features = self.node_features[concat_ranges(torch.zeros_like(num_nodes), num_nodes).to(self.device)]
+        else:
+            node_features = self.node_features[node_idx]
+        return GraphBatch(node_features, Adj_block, graph_pool, self.labels[idx.to(self.device)], graph_index, padded_neighbor_list)
+
+
+class GraphBatchSampler(Sampler):
+    def __init__(self, num_graphs, batch_size, num_batches, sampling="random"):
+        '''
+            num_graphs: number of graphs to sample from
+            batch_size: number of graphs in a minibatch
+            num_batches: number of minibatches per iteration over the sampler (random sampling)
+            sampling: independent random subset of graphs for every minibatch (random), or one shuffled pass over all graphs (epoch)
+        '''
+
+        self.num_graphs = num_graphs
+        self.batch_size = batch_size
+        self.num_batches = num_batches
+        self.sampling = sampling
+
+    def __len__(self):
+        if self.sampling == "epoch":
+            return (self.num_graphs + self.batch_size - 1) // self.batch_size
+        return self.num_batches
+
+    def __iter__(self):
+        if self.sampling == "epoch":
+            permutation = np.random.permutation(self.num_graphs)
+            for start in range(0, self.num_graphs, self.batch_size):
+                yield permutation[start:start+self.batch_size].tolist()
+        else:
+            for _ in range(self.num_batches):
+                yield np.random.permutation(self.num_graphs)[:self.batch_size].tolist()
+
+
+def graph_loader(store, batch_size, num_batches, sampling="random", num_workers=0, pin_memory=False):
+    ###DataLoader of minibatches assembled by store.batch, prefetched by worker processes if num_workers > 0
+    return DataLoader(range(len(store)), batch_sampler=GraphBatchSampler(len(store), batch_size, num_batches, sampling), collate_fn=store.batch, num_workers=num_workers, pin_memory=pin_memory, persistent_workers=num_workers > 0)
+
+
+def is_one_hot(x):
+    return x.dim() == 2 and bool(((x == 0) | (x == 1)).all()) and bool((x.sum(1) == 1).all())
+
+
+def exclusive_cumsum(x):
+    return torch.cumsum(x, 0) - x
+
+
+def concat_ranges(start, length):
+    ###concatenation of arange(start[i], start[i]+length[i]) for all i
+    return torch.repeat_interleave(start - exclusive_cumsum(length), length) + torch.arange(int(length.sum()))
+
+
+def sparse_matrix(crow, col, value, size):
+    ###CSR matrix, pytorch >= 1.12 is required (CSR spmm and scatter_reduce of the max pooling)
+    return torch.sparse_csr_tensor(crow, col, value, size)
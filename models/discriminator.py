@@ -16,17 +16,11 @@ class Discriminator(nn.Module):
             if m.bias is not None:
                 m.bias.data.fill_(0.0)
 
-    def forward(self, c, h_pl, h_mi, s_bias1=None, s_bias2=None):
-        # c_x = torch.unsqueeze(c, 1)
-        c_x = c
-        c_x_list=[]
-        for c in c_x:
-            c_x_list.append(c.expand([h_pl.shape[0]//c_x.shape[0],h_pl.shape[1]]))
-
-        c_x = torch.cat(c_x_list, 0)
-
-        sc_1= self.f_k(h_pl, c_x)
-        sc_2 = self.f_k(h_mi, c_x)
+    def forward(self, c, h_pl, h_mi, graph_index, s_bias1=None, s_bias2=None):
+        # bilinear score h^T W c of the positive and negative nodes with the summary c of their graph in one call
+        Wc = torch.mm(c, self.f_k.weight[0].t())[graph_index]
+        sc = (torch.stack([h_pl, h_mi]) * Wc).sum(2, keepdim=True) + self.f_k.bias
+        sc_1, sc_2 = sc[0], sc[1]
 
         if s_bias1 is not None:
             sc_1 += s_bias1
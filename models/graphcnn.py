@@ -1,27 +1,43 @@
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-import numpy as np
 
 import sys
 sys.path.append("models/")
 from mlp import MLP
 from discriminator import Discriminator
+from batch import GraphBatch, GraphStore
+
+
+class SymmetricSpmm(torch.autograd.Function):
+    ###product of a symmetric sparse matrix and a dense matrix, the backward reuses the sparse matrix instead of transposing it
+
+    @staticmethod
+    def forward(ctx, Adj_block, h):
+        ctx.Adj_block = Adj_block
+        return torch.spmm(Adj_block, h)
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        return None, torch.spmm(ctx.Adj_block, grad_output)
 
 
 class GIN_InfoMaxReg(nn.Module):
-    def __init__(self, num_layers, num_mlp_layers, input_dim, hidden_dim, output_dim, final_dropout, learn_eps, graph_pooling_type, neighbor_pooling_type, device):
+    def __init__(self, num_layers, num_mlp_layers, input_dim, hidden_dim, output_dim, final_dropout, learn_eps, graph_pooling_type, neighbor_pooling_type, device, dense=False, max_aggregation="padded", categorical=True):
         '''
             num_layers: number of layers in the neural networks (INCLUDING the input layer)
             num_mlp_layers: number of layers in mlps (EXCLUDING the input layer)
             input_dim: dimensionality of input features
             hidden_dim: dimensionality of hidden units at ALL layers
-            output_dim: number of classes for prediction
+            output_dim: number of classes for prediction, or list of the number of classes of each target predicted by the heads on the shared GIN layers
             final_dropout: dropout ratio on the final linear layer
             learn_eps: If True, learn epsilon to distinguish center nodes from neighboring nodes. If False, aggregate neighbors and center nodes altogether.
             neighbor_pooling_type: how to aggregate neighbors (mean, average, or max)
             graph_pooling_type: how to aggregate entire nodes in a graph (mean, average)
             device: which device to use
+            dense: If True, lists of graphs are batched as dense adjacency tensors and aggregated with batched matrix multiplication
+            max_aggregation: max neighbor pooling over gathered padded neighbor lists (padded), or scatter max over the edges (scatter)
+            categorical: If True, one-hot node features are batched as indices and the first layer looks up the columns of its first linear weight instead of multiplying the one-hot matrix (sum or average neighbor pooling)
         '''
 
         super(GIN_InfoMaxReg, self).__init__()
@@ -36,6 +52,10 @@ class GIN_InfoMaxReg(nn.Module):
         self.graph_pooling_type = graph_pooling_type
         self.neighbor_pooling_type = neighbor_pooling_type
         self.learn_eps = learn_eps
+        self.dense = dense
+        self.max_aggregation = max_aggregation
+        self.categorical = categorical
+        self.output_dims = list(output_dim) if isinstance(output_dim, (list, tuple)) else [output_dim]
         self.eps = nn.Parameter(torch.zeros(num_layers))
 
         self.mlps = torch.nn.ModuleList()
@@ -49,117 +69,63 @@ class GIN_InfoMaxReg(nn.Module):
                 self.mlps.append(MLP(num_mlp_layers, hidden_dim, hidden_dim, hidden_dim))
 
             self.batch_norms.append(nn.BatchNorm1d(hidden_dim))
-            self.linears_prediction.append(nn.Linear(hidden_dim, output_dim))
-
-
-    def __preprocess_neighbors_maxpool(self, batch_graph):
-        ###create padded_neighbor_list in concatenated graph
-
-        #compute the maximum number of neighbors within the graphs in the current minibatch
-        max_deg = max([graph.max_neighbor for graph in batch_graph])
-
-        padded_neighbor_list = []
-        start_idx = [0]
-
-
-        for i, graph in enumerate(batch_graph):
-            start_idx.append(start_idx[i] + len(graph.g))
-            padded_neighbors = []
-            for j in range(len(graph.neighbors)):
-                #add off-set values to the neighbor indices
-                pad = [n + start_idx[i] for n in graph.neighbors[j]]
-                #padding, dummy data is assumed to be stored in -1
-                pad.extend([-1]*(max_deg - len(pad)))
-
-                #Add center nodes in the maxpooling if learn_eps is False, i.e., aggregate center nodes and neighbor nodes altogether.
-                if not self.learn_eps:
-                    pad.append(j + start_idx[i])
-
-                padded_neighbors.append(pad)
-            padded_neighbor_list.extend(padded_neighbors)
-
-        return torch.LongTensor(padded_neighbor_list)
-
-
-    def __preprocess_neighbors_sumavepool(self, batch_graph):
-        ###create block diagonal sparse matrix
-
-        edge_mat_list = []
-        start_idx = [0]
-        for i, graph in enumerate(batch_graph):
-            start_idx.append(start_idx[i] + len(graph.g))
-            edge_mat_list.append(graph.edge_mat + start_idx[i])
-        Adj_block_idx = torch.cat(edge_mat_list, 1)
-        Adj_block_elem = torch.ones(Adj_block_idx.shape[1])
-
-        #Add self-loops in the adjacency matrix if learn_eps is False, i.e., aggregate center nodes and neighbor nodes altogether.
-
-        if not self.learn_eps:
-            num_node = start_idx[-1]
-            self_loop_edge = torch.LongTensor([range(num_node), range(num_node)])
-            elem = torch.ones(num_node)
-            Adj_block_idx = torch.cat([Adj_block_idx, self_loop_edge], 1)
-            Adj_block_elem = torch.cat([Adj_block_elem, elem], 0)
-
-        Adj_block = torch.sparse.FloatTensor(Adj_block_idx, Adj_block_elem, torch.Size([start_idx[-1],start_idx[-1]]))
-
-        return Adj_block.to(self.device)
-
-
-    def __preprocess_graphpool(self, batch_graph):
-        ###create sum or average pooling sparse matrix over entire nodes in each graph (num graphs x num nodes)
-
-        start_idx = [0]
-
-        #compute the padded neighbor list
-        for i, graph in enumerate(batch_graph):
-            start_idx.append(start_idx[i] + len(graph.g))
-
-        idx = []
-        elem = []
-        for i, graph in enumerate(batch_graph):
-            ###average pooling
-            if self.graph_pooling_type == "average":
-                elem.extend([1./len(graph.g)]*len(graph.g))
-
-            else:
-            ###sum pooling
-                elem.extend([1]*len(graph.g))
-
-            idx.extend([[i, j] for j in range(start_idx[i], start_idx[i+1], 1)])
-        elem = torch.FloatTensor(elem)
-        idx = torch.LongTensor(idx).transpose(0,1)
-        graph_pool = torch.sparse.FloatTensor(idx, elem, torch.Size([len(batch_graph), start_idx[-1]]))
+            #the heads of all targets are one linear layer, its output is split by split_logits
+            self.linears_prediction.append(nn.Linear(hidden_dim, sum(self.output_dims)))
+
+
+    def maxpool(self, h, padded_neighbor_list, graph_index, num_graphs):
+        ###Element-wise minimum over the nodes of each graph will never affect max-pooling, it is only taken by nodes without neighbors
+
+        #minimum of the graph of each node, so that graphs of the minibatch do not interact
+        dummy = torch.full((num_graphs, h.shape[1]), float('inf'), device=h.device).scatter_reduce(0, graph_index.unsqueeze(1).expand(-1, h.shape[1]), h, reduce='amin')[graph_index]
+        if self.max_aggregation == "scatter":
+            #padded_neighbor_list holds the (center, neighbor) edges
+            row, col = padded_neighbor_list
+            pooled_rep = torch.full_like(h, float('-inf')).scatter_reduce(0, row.unsqueeze(1).expand(-1, h.shape[1]), h[col], reduce='amax')
+            has_neighbor = torch.bincount(row, minlength=h.shape[0]) > 0
+        elif padded_neighbor_list.shape[1] == 0:
+            return dummy
+        else:
+            #padding (-1) picks the last row, which never wins the max
+            h_with_padding = torch.cat([h, torch.full((1, h.shape[1]), float('-inf'), device=h.device)])
+            pooled_rep = torch.max(h_with_padding[padded_neighbor_list], dim = 1)[0]
+            has_neighbor = (padded_neighbor_list >= 0).any(1)
+        return torch.where(has_neighbor.unsqueeze(1), pooled_rep, dummy)
 
-        return graph_pool.to(self.device)
 
+    def aggregate(self, Adj_block, h):
+        ###sum over neighbors with the block diagonal sparse adjacency, or with the dense adjacency of equally sized graphs
+        if Adj_block.dim() == 3:
+            return torch.bmm(Adj_block, h.view(Adj_block.shape[0], Adj_block.shape[1], -1)).view(h.shape)
+        return SymmetricSpmm.apply(Adj_block, h)
 
-    def maxpool(self, h, padded_neighbor_list):
-        ###Element-wise minimum will never affect max-pooling
 
-        dummy = torch.min(h, dim = 0)[0]
-        h_with_dummy = torch.cat([h, dummy.reshape((1, -1)).to(self.device)])
-        pooled_rep = torch.max(h_with_dummy[padded_neighbor_list], dim = 1)[0]
-        return pooled_rep
+    def readout(self, h, graph_pool, num_graphs):
+        ###sum or average over the nodes of each graph
+        if graph_pool is None:
+            #dense minibatch, all graphs have the same number of nodes
+            h = h.view(num_graphs, -1, h.shape[1])
+            return h.mean(1) if self.graph_pooling_type == "average" else h.sum(1)
+        return torch.spmm(graph_pool, h)
 
 
-    def next_layer_eps(self, h, layer, padded_neighbor_list = None, Adj_block = None):
+    def next_layer_eps(self, h, layer, padded_neighbor_list = None, Adj_block = None, projected = False, graph_index = None, num_graphs = None):
         ###pooling neighboring nodes and center nodes separately by epsilon reweighting.
 
         if self.neighbor_pooling_type == "max":
             ##If max pooling
-            pooled = self.maxpool(h, padded_neighbor_list)
+            pooled = self.maxpool(h, padded_neighbor_list, graph_index, num_graphs)
         else:
             #If sum or average pooling
-            pooled = torch.spmm(Adj_block, h)
+            pooled = self.aggregate(Adj_block, h)
             if self.neighbor_pooling_type == "average":
                 #If average pooling
-                degree = torch.spmm(Adj_block, torch.ones((Adj_block.shape[0], 1)).to(self.device))
+                degree = self.aggregate(Adj_block, torch.ones((h.shape[0], 1)).to(self.device))
                 pooled = pooled/degree
 
         #Reweights the center node representation when aggregating it with its neighbors
         pooled = pooled + (1 + self.eps[layer])*h
-        pooled_rep = self.mlps[layer](pooled)
+        pooled_rep = self.mlps[layer](pooled, projected)
         h = self.batch_norms[layer](pooled_rep)
 
         #non-linearity
@@ -167,22 +133,22 @@ class GIN_InfoMaxReg(nn.Module):
         return h
 
 
-    def next_layer(self, h, layer, padded_neighbor_list = None, Adj_block = None):
+    def next_layer(self, h, layer, padded_neighbor_list = None, Adj_block = None, projected = False, graph_index = None, num_graphs = None):
         ###pooling neighboring nodes and center nodes altogether
 
         if self.neighbor_pooling_type == "max":
             ##If max pooling
-            pooled = self.maxpool(h, padded_neighbor_list)
+            pooled = self.maxpool(h, padded_neighbor_list, graph_index, num_graphs)
         else:
             #If sum or average pooling
-            pooled = torch.spmm(Adj_block, h)
+            pooled = self.aggregate(Adj_block, h)
             if self.neighbor_pooling_type == "average":
                 #If average pooling
-                degree = torch.spmm(Adj_block, torch.ones((Adj_block.shape[0], 1)).to(self.device))
+                degree = self.aggregate(Adj_block, torch.ones((h.shape[0], 1)).to(self.device))
                 pooled = pooled/degree
 
         #representation of neighboring and center nodes
-        pooled_rep = self.mlps[layer](pooled)
+        pooled_rep = self.mlps[layer](pooled, projected)
 
         h = self.batch_norms[layer](pooled_rep)
 
@@ -191,33 +157,47 @@ class GIN_InfoMaxReg(nn.Module):
         return h
 
 
-    def forward(self, batch_graph, latent=False):
-        X_concat = torch.cat([graph.node_features for graph in batch_graph], 0).to(self.device)
-        graph_pool = self.__preprocess_graphpool(batch_graph)
+    def split_logits(self, c_logit):
+        ###list of the class logits of each target
+        return list(torch.split(c_logit, self.output_dims, 1))
 
-        idx = []
-        rand_seq = np.random.permutation(len(batch_graph))
-        for i in rand_seq:
-            idx += [i]*len(batch_graph[0].node_features)
 
-        if self.neighbor_pooling_type == "max":
-            padded_neighbor_list = self.__preprocess_neighbors_maxpool(batch_graph)
-        else:
-            Adj_block = self.__preprocess_neighbors_sumavepool(batch_graph)
+    def graph_store(self, graphs, device=None):
+        ###GraphStore of the graphs matching the neighbor and graph pooling of the model
+        return GraphStore(graphs, self.learn_eps, self.graph_pooling_type, self.neighbor_pooling_type, self.device if device is None else device, self.dense, self.max_aggregation, self.categorical)
+
+
+    def preprocess(self, batch_graph):
+        ###minibatch tensors of a list of S2VGraph, a GraphBatch from GraphStore is used as is
+        if isinstance(batch_graph, GraphBatch):
+            return batch_graph.to(self.device)
+        return self.graph_store(batch_graph).batch()
+
 
-        #list of hidden representation at each layer (including input)
+    def embed(self, X_concat):
+        ###one-hot input multiplied by the first linear weight, i.e. the weight columns of the nonzero features (num nodes x hidden dim)
+        return self.mlps[0].input_linear().weight.t()[X_concat]
+
+
+    def encode(self, X_concat, batch):
+        '''
+            X_concat: input node features, or the first layer input already multiplied by the first linear weight (see embed)
+            returns list of hidden representation at each layer (not including input) and the class logits
+        '''
         hidden_rep = []
         h = X_concat
+        #sum and average pooling are linear, so the first linear weight can be applied before the aggregation
+        projected = batch.node_features.dim() == 1
 
         for layer in range(self.num_layers):
             if self.neighbor_pooling_type == "max" and self.learn_eps:
-                h = self.next_layer_eps(h, layer, padded_neighbor_list = padded_neighbor_list)
+                h = self.next_layer_eps(h, layer, padded_neighbor_list = batch.padded_neighbor_list, graph_index = batch.graph_index, num_graphs = len(batch))
             elif not self.neighbor_pooling_type == "max" and self.learn_eps:
-                h = self.next_layer_eps(h, layer, Adj_block = Adj_block)
+                h = self.next_layer_eps(h, layer, Adj_block = batch.Adj_block, projected = projected and layer == 0)
             elif self.neighbor_pooling_type == "max" and not self.learn_eps:
-                h = self.next_layer(h, layer, padded_neighbor_list = padded_neighbor_list)
+                h = self.next_layer(h, layer, padded_neighbor_list = batch.padded_neighbor_list, graph_index = batch.graph_index, num_graphs = len(batch))
             elif not self.neighbor_pooling_type == "max" and not self.learn_eps:
-                h = self.next_layer(h, layer, Adj_block = Adj_block)
+                h = self.next_layer(h, layer, Adj_block = batch.Adj_block, projected = projected and layer == 0)
 
             hidden_rep.append(h)
 
@@ -226,74 +206,64 @@ class GIN_InfoMaxReg(nn.Module):
 
         #perform pooling over all nodes in each graph in every layer
         for layer, h in enumerate(hidden_rep):
-            pooled_h = torch.spmm(graph_pool, h)
+            pooled_h = self.readout(h, batch.graph_pool, len(batch))
             c_logit += F.dropout(self.linears_prediction[layer](pooled_h), self.final_dropout, training = self.training) # [32,2]
             graph_latent.append(pooled_h)
 
-        n_f = torch.cat(hidden_rep, 1)
-        g_f = torch.cat(graph_latent, 1)
-
-        h_1 = n_f
-
-        c = g_f
-        c = self.sigm(c)
-
-        idx = np.asarray(idx)
-        shuf_n_f = n_f[idx, :]
+        return hidden_rep, graph_latent, c_logit
 
-        h_2 = shuf_n_f
 
-        d_logit = self.disc(c, h_1, h_2, None, None)
+    def forward(self, batch_graph, latent=False, discriminator=True):
+        '''
+            latent: If True, return the graph latent as a numpy array
+            discriminator: If False, the InfoMax discriminator is skipped and None is returned in place of its logits
+        '''
+        batch = self.preprocess(batch_graph)
+        X_concat = batch.node_features
+        if X_concat.dim() == 1:
+            X_concat = self.embed(X_concat)
+        hidden_rep, graph_latent, c_logit = self.encode(X_concat, batch)
 
+        g_f = torch.cat(graph_latent, 1)
         if latent:
             return g_f.detach().cpu().numpy()
-        else:
-            return c_logit, d_logit
+        if not discriminator:
+            return c_logit, None
 
+        n_f = torch.cat(hidden_rep, 1)
+        c = self.sigm(g_f)
 
-    def compute_saliency(self, batch_graph, cls):
-        self.eval()
-        self.zero_grad()
-        assert len(batch_graph)==1
-        X_concat = torch.cat([graph.node_features for graph in batch_graph], 0).to(self.device)
-        X_concat.requires_grad_()
-        graph_pool = self.__preprocess_graphpool(batch_graph)
-
-        # predicting 0
-        predicting_class = torch.zeros([1,2]).to(self.device)
-        predicting_class[0, cls] = 1
+        #negative samples: the rows of n_f given by a random permutation of the graph indices, repeated over the nodes of each graph
+        rand_seq = torch.randperm(len(batch), device=self.device)
+        shuf_n_f = n_f[rand_seq[batch.graph_index]]
 
-        if self.neighbor_pooling_type == "max":
-            padded_neighbor_list = self.__preprocess_neighbors_maxpool(batch_graph)
-        else:
-            Adj_block = self.__preprocess_neighbors_sumavepool(batch_graph)
+        d_logit = self.disc(c, n_f, shuf_n_f, batch.graph_index, None, None)
 
-        #list of hidden representation at each layer (not including input)
-        hidden_rep = []
-        h = X_concat
+        return c_logit, d_logit
 
-        for layer in range(self.num_layers):
-            if self.neighbor_pooling_type == "max" and self.learn_eps:
-                h = self.next_layer_eps(h, layer, padded_neighbor_list = padded_neighbor_list)
-            elif not self.neighbor_pooling_type == "max" and self.learn_eps:
-                h = self.next_layer_eps(h, layer, Adj_block = Adj_block)
-            elif self.neighbor_pooling_type == "max" and not self.learn_eps:
-                h = self.next_layer(h, layer, padded_neighbor_list = padded_neighbor_list)
-            elif not self.neighbor_pooling_type == "max" and not self.learn_eps:
-                h = self.next_layer(h, layer, Adj_block = Adj_block)
-            h.retain_grad()
-            hidden_rep.append(h)
 
-        score_over_layer = 0
-        class_activation = torch.zeros([X_concat.shape[0]]).to(self.device)
-        grad_class_activation = torch.zeros([X_concat.shape[0]]).to(self.device)
+    def compute_saliency(self, batch_graph, cls):
+        '''
+            cls: class (column of the concatenated logits of all targets) to compute the saliency of, or a list of classes computed from one shared forward pass
+            returns the gradient of the class score with respect to the input node features (num nodes x input dim), stacked over the classes if cls is a list
+        '''
+        self.eval()
+        batch = self.preprocess(batch_graph)
+        if batch.node_features.dim() == 1:
+            #gradient with respect to the one-hot input is the gradient of the embedded input times the first linear weight
+            X_concat = self.embed(batch.node_features)
+            weight = self.mlps[0].input_linear().weight
+        else:
+            X_concat = batch.node_features.clone()
+            X_concat.requires_grad_()
 
-        #perform pooling over all nodes in each graph in every layer
-        for layer, h in enumerate(hidden_rep):
-            pooled_h = torch.spmm(graph_pool, h)
-            score_over_layer += F.dropout(self.linears_prediction[layer](pooled_h), self.final_dropout, training = self.training)
+        _, _, score_over_layer = self.encode(X_concat, batch)
 
-        score_over_layer.backward(predicting_class)
-        saliency = X_concat.grad
+        #the batch norm uses its running statistics in eval mode and the max pooling dummy is taken per graph (see maxpool),
+        #so graphs do not interact and the gradient of the summed score gives the saliency of every graph
+        classes = cls if isinstance(cls, (list, tuple)) else [cls]
+        saliency = [torch.autograd.grad(score_over_layer[:, c].sum(), X_concat, retain_graph=True)[0] for c in classes]
+        if batch.node_features.dim() == 1:
+            saliency = [torch.mm(s, weight.detach()) for s in saliency]
 
-        return saliency
+        return torch.stack(saliency) if isinstance(cls, (list, tuple)) else saliency[0]
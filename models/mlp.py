@@ -37,13 +37,20 @@ class MLP(nn.Module):
             for layer in range(num_layers - 1):
                 self.batch_norms.append(nn.BatchNorm1d((hidden_dim)))
 
-    def forward(self, x):
+    def input_linear(self):
+        return self.linear if self.linear_or_not else self.linears[0]
+
+    def forward(self, x, projected=False):
+        '''
+            projected: If True, x is already multiplied by the weight of the first linear layer and only its bias is added
+        '''
         if self.linear_or_not:
             #If linear model
-            return self.linear(x)
+            return x + self.linear.bias if projected else self.linear(x)
         else:
             #If MLP
             h = x
             for layer in range(self.num_layers - 1):
-                h = F.relu(self.batch_norms[layer](self.linears[layer](h)))
+                h = h + self.linears[layer].bias if layer == 0 and projected else self.linears[layer](h)
+                h = F.relu(self.batch_norms[layer](h))
             return self.linears[self.num_layers - 1](h)
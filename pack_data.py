@@ -0,0 +1,86 @@
+import os
+import argparse
+import numpy as np
+from tqdm import tqdm
+from dataset import read_matrix
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Pack the connectivity and timeseries text files into a single memory-mapped store')
+    parser.add_argument('--sourcedir', type=str, default='data', help='path to the data directory, the store is written to sourcedir/packed')
+    parser.add_argument('--skip_timeseries', action='store_true', help='pack only the connectivity matrices')
+    opt = parser.parse_args()
+
+    packdir = os.path.join(opt.sourcedir, 'packed')
+    os.makedirs(packdir, exist_ok=True)
+    if os.path.isfile(os.path.join(packdir, 'subjects.npy')):
+        os.remove(os.path.join(packdir, 'subjects.npy'))
+
+    #timeseries-only source directories (--connectivity timeseries) have no connectivity matrices to pack
+    connectivity_subjects = []
+    if os.path.isdir(os.path.join(opt.sourcedir, 'connectivity')):
+        connectivity_subjects = sorted([subject.split('.')[0][1:] for subject in os.listdir(os.path.join(opt.sourcedir, 'connectivity'))])
+    timeseries_subjects = []
+    if not opt.skip_timeseries and os.path.isdir(os.path.join(opt.sourcedir, 'timeseries')):
+        timeseries_subjects = sorted([subject.split('.')[0] for subject in os.listdir(os.path.join(opt.sourcedir, 'timeseries'))])
+    subjects = sorted(set(connectivity_subjects) | set(timeseries_subjects))
+
+    pack_connectivity(opt.sourcedir, packdir, subjects, connectivity_subjects)
+    pack_timeseries(opt.sourcedir, packdir, subjects, timeseries_subjects)
+
+    #subjects are written last, the store is not used before it is complete
+    np.save(os.path.join(packdir, 'subjects.npy'), np.array(subjects))
+
+
+def pack_connectivity(sourcedir, packdir, subjects, connectivity_subjects):
+    ###upper triangle (including the diagonal) of each symmetric connectivity matrix as float32
+    connectivity_subjects = set(connectivity_subjects)
+    connectivity_index = np.full(len(subjects), -1)
+    connectivity = None
+    for i, subject in enumerate(tqdm(subjects, ncols=50, desc='connectivity')):
+        if not subject in connectivity_subjects: continue
+        matrix = read_matrix(os.path.join(sourcedir, 'connectivity', f'r{subject}.txt'))
+        if not np.allclose(matrix, matrix.T):
+            raise ValueError(f'connectivity matrix of subject {subject} is not symmetric')
+        if connectivity is None:
+            triu_idx = np.triu_indices(matrix.shape[0])
+            connectivity = np.lib.format.open_memmap(os.path.join(packdir, 'connectivity.npy'), mode='w+', dtype=np.float32, shape=(len(connectivity_subjects), len(triu_idx[0])))
+        connectivity_index[i] = connectivity_index.max() + 1
+        connectivity[connectivity_index[i]] = matrix[triu_idx]
+    if connectivity is None:
+        connectivity = np.zeros((0, 0), dtype=np.float32)
+        np.save(os.path.join(packdir, 'connectivity.npy'), connectivity)
+    else:
+        connectivity.flush()
+    np.save(os.path.join(packdir, 'connectivity_index.npy'), connectivity_index)
+
+
+def pack_timeseries(sourcedir, packdir, subjects, timeseries_subjects):
+    ###timeseries of all subjects concatenated along time, subject i spans rows offsets[i]:offsets[i+1]
+    timeseries_subjects = set(timeseries_subjects)
+    lengths = []
+    for subject in subjects:
+        if subject in timeseries_subjects:
+            with open(os.path.join(sourcedir, 'timeseries', f'{subject}.txt')) as f:
+                lengths.append(sum([1 for line in f if line.strip()]))
+        else:
+            lengths.append(0)
+    offsets = np.cumsum([0] + lengths)
+
+    timeseries = None
+    for i, subject in enumerate(tqdm(subjects, ncols=50, desc='timeseries')):
+        if not subject in timeseries_subjects: continue
+        matrix = read_matrix(os.path.join(sourcedir, 'timeseries', f'{subject}.txt'))
+        if timeseries is None:
+            timeseries = np.lib.format.open_memmap(os.path.join(packdir, 'timeseries.npy'), mode='w+', dtype=np.float32, shape=(int(offsets[-1]), matrix.shape[1]))
+        timeseries[offsets[i]:offsets[i+1]] = matrix
+    if timeseries is None:
+        timeseries = np.zeros((0, 0), dtype=np.float32)
+        np.save(os.path.join(packdir, 'timeseries.npy'), timeseries)
+    else:
+        timeseries.flush()
+    np.save(os.path.join(packdir, 'timeseries_offsets.npy'), offsets)
+
+
+if __name__ == '__main__':
+    main()
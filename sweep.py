@@ -0,0 +1,191 @@
+import os
+import csv
+import math
+import random
+import argparse
+import itertools
+import multiprocessing
+import numpy as np
+import torch
+import torch.optim as optim
+
+from models.graphcnn import *
+from batch import graph_loader
+from util import load_data_thresholds, separate_data
+from main import get_parser, train, test
+
+#graphs of each data key and sparsity level loaded once in the parent process, inherited by the forked trial workers
+sweep_data = {}
+
+
+def data_key(args):
+    ###options that change the graphs loaded by load_data_thresholds, except the sparsity levels which are loaded in one pass
+    return (args.sourcedir, args.input_feature, args.edge_weight, tuple(args.targets), args.connectivity)
+
+
+def init_trial_worker(num_threads):
+    torch.set_num_threads(num_threads)
+
+
+def parse_bool(value):
+    if value in ['True', 'true', '1']:
+        return True
+    if value in ['False', 'false', '0']:
+        return False
+    raise ValueError('invalid boolean value {}'.format(value))
+
+
+def parse_space(parser, space):
+    '''
+        space: name=value,value,... specs, the items of a list option (e.g. targets) are joined by + within each value
+        values are converted with the type of the main.py option, store_true and store_false options take True or False
+    '''
+    actions = {action.dest: action for action in parser._actions}
+    search_space = {}
+    for spec in space:
+        name, values = spec.split('=')
+        if not name in actions:
+            raise ValueError('unknown option {} in the search space'.format(name))
+        action = actions[name]
+        if isinstance(action, (argparse._StoreTrueAction, argparse._StoreFalseAction)):
+            convert = parse_bool
+        else:
+            convert = action.type or str
+        if action.nargs in ['+', '*']:
+            search_space[name] = [[convert(item) for item in value.split('+')] for value in values.split(',')]
+        else:
+            search_space[name] = [convert(value) for value in values.split(',')]
+        for value in search_space[name]:
+            if action.choices is not None and not all([item in action.choices for item in (value if isinstance(value, list) else [value])]):
+                raise ValueError('invalid value {} of option {} in the search space, choose from {}'.format(value, name, action.choices))
+    return search_space
+
+
+def sample_trials(search_space, search, num_trials, seed):
+    ###all combinations of the search space (grid), or num_trials random combinations (random)
+    names = sorted(search_space.keys())
+    if search == 'grid':
+        return [dict(zip(names, values)) for values in itertools.product(*[search_space[name] for name in names])]
+    rng = random.Random(seed)
+    return [{name: rng.choice(search_space[name]) for name in names} for _ in range(num_trials)]
+
+
+def run_trial(trial):
+    '''
+        trial: (trial index, args of the trial, epochs to train up to)
+        training resumes from the checkpoint of the previous rung, returns the validation metrics
+    '''
+    trial_idx, args, epochs = trial
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    torch.manual_seed(args.fold_seed + trial_idx)
+    np.random.seed(args.fold_seed + trial_idx)
+
+    graphs, num_classes = sweep_data[data_key(args) + (args.sparsity,)]
+    #hyperparameters are selected on a validation split of the training graphs, the test fold is left untouched
+    train_graphs, _ = separate_data(graphs, args.fold_seed, args.fold_idx)
+    train_graphs, val_graphs = separate_data(train_graphs, args.fold_seed, 0)
+
+    model = GIN_InfoMaxReg(args.num_layers, args.num_mlp_layers, train_graphs[0].node_features.shape[1], args.hidden_dim, num_classes, args.final_dropout, args.learn_eps, args.graph_pooling_type, args.neighbor_pooling_type, device, args.adjacency=='dense', args.max_aggregation).to(device)
+    train_store = model.graph_store(train_graphs)
+    train_loader = graph_loader(train_store, args.batch_size, args.iters_per_epoch, args.sampling)
+    val_store = model.graph_store(val_graphs)
+    optimizer = optim.Adam(model.parameters(), lr=args.lr)
+    scheduler = optim.lr_scheduler.StepLR(optimizer, step_size=args.lr_step, gamma=args.lr_rate)
+
+    checkpoint_path = 'results/{}/sweep/trial_{}.pt'.format(args.exp, trial_idx)
+    start_epoch = 0
+    if os.path.isfile(checkpoint_path):
+        checkpoint = torch.load(checkpoint_path, map_location=device)
+        model.load_state_dict(checkpoint['model'])
+        optimizer.load_state_dict(checkpoint['optimizer'])
+        scheduler.load_state_dict(checkpoint['scheduler'])
+        start_epoch = checkpoint['epoch']
+        #the random states continue from the end of the previous rung, so that the minibatches match a run without interruption
+        torch.set_rng_state(checkpoint['rng']['torch'].cpu())
+        name, key, pos, has_gauss, cached_gaussian = checkpoint['rng']['numpy']
+        np.random.set_state((name, key.cpu().numpy().astype(np.uint32), pos, has_gauss, cached_gaussian))
+        if checkpoint['rng']['cuda'] is not None:
+            torch.cuda.set_rng_state_all([state.cpu() for state in checkpoint['rng']['cuda']])
+
+    loss_train = float('nan')
+    for epoch in range(start_epoch, epochs):
+        loss_train = train(args, model, device, train_loader, optimizer, args.beta, epoch)
+        scheduler.step()
+
+    #the numpy state is kept as a tensor and python scalars, which torch.load accepts with weights_only
+    name, key, pos, has_gauss, cached_gaussian = np.random.get_state()
+    rng = {'torch': torch.get_rng_state(), 'numpy': (name, torch.from_numpy(key.astype(np.int64)), int(pos), int(has_gauss), float(cached_gaussian)), 'cuda': torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None}
+    torch.save({'model': model.state_dict(), 'optimizer': optimizer.state_dict(), 'scheduler': scheduler.state_dict(), 'epoch': epochs, 'rng': rng}, checkpoint_path)
+    acc_val, precision_val, recall_val = test(args, model, device, val_store)
+    #metrics of several targets are averaged
+    return trial_idx, {'epochs': epochs, 'loss': float(loss_train), 'accuracy': np.mean(acc_val), 'precision': np.mean(precision_val), 'recall': np.mean(recall_val)}
+
+
+def rung_epochs(min_epochs, eta, max_epochs):
+    ###epochs of each successive halving rung, a single rung of max_epochs without early stopping
+    if min_epochs <= 0 or min_epochs >= max_epochs:
+        return [max_epochs]
+    epochs = [min_epochs]
+    while epochs[-1]*eta < max_epochs:
+        epochs.append(epochs[-1]*eta)
+    return epochs + [max_epochs]
+
+
+def main():
+    parser = get_parser()
+    parser.description = 'PyTorch GIN fMRI hyperparameter sweep'
+    parser.add_argument('--space', type=str, nargs='+', required=True, help='search space as name=value,value,... of the training options, e.g. sparsity=10,20,30 hidden_dim=32,64 learn_eps=True,False targets=Gender,Gender+Age')
+    parser.add_argument('--search', type=str, default='grid', choices=['grid', 'random'], help='all combinations of the search space, or num_trials random combinations')
+    parser.add_argument('--num_trials', type=int, default=10, help='number of trials of the random search')
+    parser.add_argument('--min_epochs', type=int, default=0, help='epochs of the first successive halving rung, all trials are trained for the full epochs if 0')
+    parser.add_argument('--eta', type=int, default=3, help='successive halving rate: 1/eta of the trials are kept and trained eta times longer at each rung')
+    parser.add_argument('--metric', type=str, default='accuracy', choices=['accuracy', 'precision', 'recall'], help='validation metric to rank the trials')
+    parser.add_argument('--trial_workers', type=int, default=0, help='number of trials trained concurrently, one per cpu if 0')
+    parser.add_argument('--threads_per_trial', type=int, default=1, help='number of torch threads of each trial process')
+    args = parser.parse_args()
+
+    search_space = parse_space(parser, args.space)
+    trials = [argparse.Namespace(**dict(vars(args), **params)) for params in sample_trials(search_space, args.search, args.num_trials, args.fold_seed)]
+    os.makedirs('results/{}/sweep'.format(args.exp), exist_ok=True)
+    #checkpoints of a previous sweep of the experiment would be resumed by the first rung
+    for file in os.listdir('results/{}/sweep'.format(args.exp)):
+        if file.startswith('trial_'):
+            os.remove(os.path.join('results/{}/sweep'.format(args.exp), file))
+
+    #the graphs of all sparsity levels are loaded (or read from cachedir) in one pass per data key
+    for key in sorted(set([data_key(trial_args) for trial_args in trials])):
+        sourcedir, input_feature, edge_weight, targets, connectivity = key
+        thresholds = sorted(set([trial_args.sparsity for trial_args in trials if data_key(trial_args) == key]))
+        for threshold, data in load_data_thresholds(sourcedir, thresholds, input_feature, args.cachedir, args.num_workers, edge_weight, list(targets), connectivity).items():
+            sweep_data[key + (threshold,)] = data
+
+    trial_workers = args.trial_workers if args.trial_workers > 0 else os.cpu_count()
+    results = {}
+    alive = list(range(len(trials)))
+    epochs = rung_epochs(args.min_epochs, args.eta, args.epochs)
+    with multiprocessing.get_context('fork').Pool(trial_workers, initializer=init_trial_worker, initargs=(args.threads_per_trial,)) as pool:
+        for rung, rung_epoch in enumerate(epochs):
+            for trial_idx, metrics in pool.imap_unordered(run_trial, [(trial_idx, trials[trial_idx], rung_epoch) for trial_idx in alive], chunksize=1):
+                results[trial_idx] = metrics
+                print('rung {} trial {}: {} epochs, validation {} {:.4f}'.format(rung, trial_idx, rung_epoch, args.metric, metrics[args.metric]))
+            #successive halving: keep the best 1/eta of the trials for the next rung
+            if rung < len(epochs)-1:
+                alive = sorted(alive, key=lambda trial_idx: -results[trial_idx][args.metric])[:max(1, math.ceil(len(alive)/args.eta))]
+
+    ###summary table of all trials, sorted by the epochs reached and the validation metric
+    names = sorted(search_space.keys())
+    order = sorted(results.keys(), key=lambda trial_idx: (-results[trial_idx]['epochs'], -results[trial_idx][args.metric]))
+    with open('results/{}/sweep/summary.csv'.format(args.exp), 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['trial'] + names + ['epochs', 'loss', 'accuracy', 'precision', 'recall'])
+        for trial_idx in order:
+            metrics = results[trial_idx]
+            writer.writerow([trial_idx] + [getattr(trials[trial_idx], name) for name in names] + [metrics['epochs'], metrics['loss'], metrics['accuracy'], metrics['precision'], metrics['recall']])
+
+    print('{:>6} '.format('trial') + ' '.join(['{:>14}'.format(name) for name in names]) + ' {:>7} {:>9}'.format('epochs', args.metric))
+    for trial_idx in order:
+        print('{:>6} '.format(trial_idx) + ' '.join(['{:>14}'.format(str(getattr(trials[trial_idx], name))) for name in names]) + ' {:>7} {:>9.4f}'.format(results[trial_idx]['epochs'], results[trial_idx][args.metric]))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,132 +1,224 @@
 import os
+import json
 import random
+import hashlib
+import multiprocessing
 import numpy as np
-import networkx as nx
 import torch
+from functools import partial
 from dataset import *
 from sklearn.model_selection import StratifiedKFold
 
+CACHE_VERSION = 1
+subject_loader = {}
+
+
 class S2VGraph(object):
+    ###array-backed graph: neighbors in CSR arrays, node features may be one tensor shared by all graphs
+    __slots__ = ['label', 'g', 'node_tags', 'node_features', 'neighbor_offsets', 'neighbor_index', 'edge_weight', 'max_neighbor']
+
     def __init__(self, g, label, node_tags=None, node_features=None):
         self.label = label
         self.g = g
         self.node_tags = node_tags
-        self.neighbors = []
         self.node_features = 0
-        self.edge_mat = 0
+        self.neighbor_offsets = np.zeros(1, dtype=np.int32)
+        self.neighbor_index = np.zeros(0, dtype=np.int32)
+        self.edge_weight = None
         self.max_neighbor = 0
 
+    @property
+    def neighbors(self):
+        return [neighbors.tolist() for neighbors in np.split(self.neighbor_index, self.neighbor_offsets[1:-1])]
 
-def load_data(sourcedir, threshold, type):
-    subject_list = [subject.split('.')[0][1:] for subject in os.listdir(os.path.join(sourcedir, 'connectivity'))]
-    subject_list.sort()
+    @property
+    def edge_mat(self):
+        ###(2 x num directed edges) row-sorted edges, edge_weight is aligned with its columns
+        row = np.repeat(np.arange(len(self.neighbor_offsets)-1), np.diff(self.neighbor_offsets))
+        return torch.from_numpy(np.stack([row, self.neighbor_index.astype(np.int64)]))
 
-    behav = DataBehavioral(sourcedir)
-    roi = DataNodes(sourcedir)
-    connectivity = DataEdges(sourcedir)
 
-    _, behav_labels = behav.get_feature(['Gender'])
+def load_data(sourcedir, threshold, type, cachedir=None, num_workers=0, edge_weight='binary', targets=['Gender'], connectivity='precomputed'):
+    return load_data_thresholds(sourcedir, [threshold], type, cachedir, num_workers, edge_weight, targets, connectivity)[threshold]
 
-    g_list = []
-    label_dict = {}
-    feat_dict = {}
-    for i, subject in enumerate(subject_list):
-        if 'bold' in type: roi(subject)
-        _, node_labels = roi.get_feature(type)
-        connectivity(subject)
-        _, connection = connectivity.get_adjacency(100-threshold)
-        n = node_labels
-        l = behav_labels['Gender'][int(subject)]
-        if not l in label_dict:
-            mapped = len(label_dict)
-            label_dict[l] = mapped
-        g = nx.Graph()
-        node_tags = []
-        node_features = []
-        n_edges = 0
-        for j, node_label in enumerate(n.keys()):
-            g.add_node(j)
-            row = [node_labels[node_label]]
-            if j in connection:
-                row += [len(connection[j])]
-                row += connection[j]
-            else:
-                row += [0]
-            tmp = int(row[1]) + 2
-            if tmp == len(row):
-                attr = None
-            else:
-                row, attr = [int(w) for w in row[:tmp]], np.array([float(w) for w in row[tmp:]])
+
+def load_data_thresholds(sourcedir, thresholds, type, cachedir=None, num_workers=0, edge_weight='binary', targets=['Gender'], connectivity='precomputed'):
+    '''
+        graphs of several sparsity thresholds from one pass over the subjects, returns dict {threshold: (graphs, num_classes)}
+        edge_weight: binary edges, or the connectivity values of the edges kept as float16 or float32 in g.edge_weight
+        targets: behavioral columns to label the graphs with. For several targets, g.label is a tuple of the labels of each target and num_classes is a list
+        connectivity: precomputed connectivity matrices, or correlation of the timeseries computed while streaming them
+    '''
+    data = {}
+    if cachedir:
+        cachepaths = {threshold: os.path.join(cachedir, cache_key(sourcedir, threshold, type, edge_weight, targets, connectivity)) for threshold in thresholds}
+        for threshold in thresholds:
+            if os.path.isfile(os.path.join(cachepaths[threshold], 'meta.json')):
+                data[threshold] = load_cache(cachepaths[threshold])
+    thresholds = [threshold for threshold in thresholds if not threshold in data]
+    if len(thresholds) == 0:
+        return data
+
+    subject_list = DataEdges(sourcedir, connectivity).get_subjects()
+
+    behav = DataBehavioral(sourcedir)
+    _, behav_labels = behav.get_feature(targets)
+
+    #subjects are parsed independently, results are returned in the order of subject_list
+    load_fn = partial(load_subject, thresholds=thresholds, type=type, edge_weight=edge_weight)
+    if num_workers > 0:
+        with multiprocessing.Pool(num_workers, initializer=init_subject_loader, initargs=(sourcedir, connectivity)) as pool:
+            subject_data = pool.map(load_fn, subject_list, chunksize=max(1, len(subject_list)//(4*num_workers)))
+    else:
+        init_subject_loader(sourcedir, connectivity)
+        subject_data = map(load_fn, subject_list)
+
+    g_lists = {threshold: [] for threshold in thresholds}
+    label_dicts = [{} for target in targets]
+    #subjects with the same node labels share the node feature tensor
+    shared_features = {}
+    for subject, (node_labels, edges, weights, counts) in zip(subject_list, subject_data):
+        label = []
+        for target, label_dict in zip(targets, label_dicts):
+            l = behav_labels[target][int(subject)]
+            #missing values keep the label -1, which is ignored by the loss and the metrics
+            if l < 0:
+                label.append(-1)
+                continue
+            if not l in label_dict:
+                mapped = len(label_dict)
+                label_dict[l] = mapped
+            label.append(label_dict[l])
+        label = label[0] if len(targets) == 1 else tuple(label)
+
+        key = tuple(node_labels)
+        if not key in shared_features:
             if type=='one_hot':
-                if not row[0] in feat_dict:
-                    mapped = len(feat_dict)
-                    feat_dict[row[0]] = mapped
-                node_tags.append(feat_dict[row[0]])
+                #node labels of the one-hot feature are indices of the unique ROI labels, which are shared across subjects
+                node_features = torch.zeros(len(node_labels), max(node_labels)+1)
+                node_features[range(len(node_labels)), node_labels] = 1
             else:
-                node_tags.append(row[0])
-
-            if tmp > len(row):
-                node_features.append(attr)
-
-            n_edges += row[1]
-            for k in range(2, len(row)):
-                g.add_edge(j, row[k])
-
-        if node_features != []:
-            node_features = np.stack(node_features)
-            node_feature_flag = True
-        else:
-            node_features = None
-            node_feature_flag = False
-        assert len(g) == len(n)
-
-        g_list.append(S2VGraph(g, l, node_tags))
-
-    #add labels and edge_mat
-    for g in g_list:
-        g.neighbors = [[] for i in range(len(g.g))]
-        for i, j in g.g.edges():
-            g.neighbors[i].append(j)
-            g.neighbors[j].append(i)
-        degree_list = []
-        for i in range(len(g.g)):
-            g.neighbors[i] = g.neighbors[i]
-            degree_list.append(len(g.neighbors[i]))
-        g.max_neighbor = max(degree_list)
-
-        g.label = label_dict[g.label]
-
-        edges = [list(pair) for pair in g.g.edges()]
-        edges.extend([[i, j] for j, i in edges])
-
-        deg_list = list(dict(g.g.degree(range(len(g.g)))).values())
-        g.edge_mat = torch.LongTensor(edges).transpose(0,1)
-
-    #Extracting unique tag labels
-    tagset = set([])
-    for g in g_list:
-        tagset = tagset.union(set(g.node_tags))
-
-    tagset = list(tagset)
-    tag2index = {tagset[i]:i for i in range(len(tagset))}
-
-    for g in g_list:
-        if type=='one_hot':
-            g.node_features = torch.zeros(len(g.node_tags), len(tagset))
-            g.node_features[range(len(g.node_tags)), [tag2index[tag] for tag in g.node_tags]] = 1
-        else:
-            g.node_features = torch.zeros(len(g.node_tags), len(g.node_tags[0]))
-            for i in range(len(g.node_tags)):
-                for j in range(len(g.node_tags[0])):
-                    g.node_features[i, j] = g.node_tags[i][j]
-    return g_list, len(label_dict)
+                node_features = torch.FloatTensor(node_labels)
+            shared_features[key] = (np.array(node_labels), node_features)
+        node_tags, node_features = shared_features[key]
+
+        #the edges of each threshold are a prefix of the edges sorted by weight, the node features are shared
+        for threshold, count in zip(thresholds, counts):
+            g = S2VGraph(None, label, node_tags)
+            set_edges(g, edges[:count], len(node_labels), None if weights is None else weights[:count])
+            g.node_features = node_features
+            g_lists[threshold].append(g)
+
+    num_classes = len(label_dicts[0]) if len(targets) == 1 else [len(label_dict) for label_dict in label_dicts]
+    for threshold in thresholds:
+        data[threshold] = (g_lists[threshold], num_classes)
+        if cachedir:
+            save_cache(cachepaths[threshold], g_lists[threshold], num_classes)
+    return data
+
+
+def cache_key(sourcedir, threshold, type, edge_weight='binary', targets=['Gender'], connectivity='precomputed'):
+    ###hash of the source files (path, size, mtime) together with the preprocessing options
+    h = hashlib.sha1('{}_{}_{}_{}_{}_{}'.format(CACHE_VERSION, threshold, type, edge_weight, '-'.join(targets), connectivity).encode())
+    for subdir in ['behavioral', 'roi', 'connectivity', 'timeseries', 'packed']:
+        if subdir=='timeseries' and not 'bold' in type and not connectivity=='timeseries': continue
+        if subdir=='connectivity' and connectivity=='timeseries': continue
+        for root, dirs, files in os.walk(os.path.join(sourcedir, subdir)):
+            dirs.sort()
+            for file in sorted(files):
+                stat = os.stat(os.path.join(root, file))
+                h.update('{}_{}_{}'.format(os.path.relpath(os.path.join(root, file), sourcedir), stat.st_size, stat.st_mtime_ns).encode())
+    return h.hexdigest()
+
+
+def save_cache(cachepath, g_list, num_classes):
+    ###store edges (upper triangle), node features and labels of all graphs as flat arrays
+    os.makedirs(cachepath, exist_ok=True)
+    edge_mats = [g.edge_mat.numpy() for g in g_list]
+    upper = [edge_mat[0] < edge_mat[1] for edge_mat in edge_mats]
+    edges = [edge_mat[:, mask].T for edge_mat, mask in zip(edge_mats, upper)]
+    edge_offsets = np.cumsum([0] + [len(e) for e in edges])
+
+    #subject-invariant node features are stored only once
+    if all([g.node_features is g_list[0].node_features or torch.equal(g.node_features, g_list[0].node_features) for g in g_list]):
+        node_features = g_list[0].node_features.unsqueeze(0).numpy()
+    else:
+        node_features = torch.stack([g.node_features for g in g_list]).numpy()
+
+    np.save(os.path.join(cachepath, 'edges.npy'), np.concatenate(edges).astype(np.int32))
+    np.save(os.path.join(cachepath, 'edge_offsets.npy'), edge_offsets)
+    np.save(os.path.join(cachepath, 'node_features.npy'), node_features)
+    np.save(os.path.join(cachepath, 'labels.npy'), np.array([g.label for g in g_list]))
+    if g_list[0].edge_weight is not None:
+        np.save(os.path.join(cachepath, 'edge_weights.npy'), np.concatenate([g.edge_weight.numpy()[mask] for g, mask in zip(g_list, upper)]))
+
+    #meta is written last so that an interrupted save is never loaded
+    with open(os.path.join(cachepath, 'meta.json'), 'w') as f:
+        json.dump({'version': CACHE_VERSION, 'num_graphs': len(g_list), 'num_classes': num_classes}, f)
+
+
+def load_cache(cachepath):
+    with open(os.path.join(cachepath, 'meta.json')) as f:
+        meta = json.load(f)
+    edges = np.load(os.path.join(cachepath, 'edges.npy'), mmap_mode='r')
+    edge_offsets = np.load(os.path.join(cachepath, 'edge_offsets.npy'))
+    node_features = np.load(os.path.join(cachepath, 'node_features.npy'), mmap_mode='r')
+    labels = np.load(os.path.join(cachepath, 'labels.npy'))
+    edge_weights = None
+    if os.path.isfile(os.path.join(cachepath, 'edge_weights.npy')):
+        edge_weights = np.load(os.path.join(cachepath, 'edge_weights.npy'), mmap_mode='r')
+
+    #subject-invariant node features are loaded as one tensor shared by all graphs
+    shared_features = torch.from_numpy(np.array(node_features[0])) if len(node_features) == 1 else None
+
+    g_list = []
+    for i in range(meta['num_graphs']):
+        features = shared_features if shared_features is not None else torch.from_numpy(np.array(node_features[i]))
+        g = S2VGraph(None, int(labels[i]) if labels.ndim == 1 else tuple(labels[i].tolist()))
+        weights = None if edge_weights is None else np.array(edge_weights[edge_offsets[i]:edge_offsets[i+1]])
+        set_edges(g, np.array(edges[edge_offsets[i]:edge_offsets[i+1]], dtype=np.int64), features.shape[0], weights)
+        g.node_features = features
+        g_list.append(g)
+    return g_list, meta['num_classes']
+
+
+def init_subject_loader(sourcedir, connectivity='precomputed'):
+    ###per-process ROI and connectivity readers used by load_subject
+    subject_loader['roi'] = DataNodes(sourcedir)
+    subject_loader['connectivity'] = DataEdges(sourcedir, connectivity)
+
+
+def load_subject(subject, thresholds, type, edge_weight='binary'):
+    roi = subject_loader['roi']
+    connectivity = subject_loader['connectivity']
+    connectivity(subject)
+    #the timeseries is streamed once when both the connectivity and the node features are computed from it
+    if 'bold' in type: roi(subject, connectivity.timeseries_stats)
+    _, node_labels = roi.get_feature(type)
+    edges, weights, counts = connectivity.get_edges_nested([100-threshold for threshold in thresholds])
+    #only the edges of the lowest threshold are kept
+    weights = None if edge_weight=='binary' else weights[:counts.max()].astype(edge_weight)
+    return list(node_labels.values()), edges[:counts.max()], weights, counts
+
+
+def set_edges(g, edges, num_nodes, weights=None):
+    ###fill in the CSR neighbors and max_neighbor from the undirected edge array of shape (num_edges, 2), and edge_weight aligned with the neighbors
+    edge_mat = np.concatenate([edges, edges[:, ::-1]]).T
+    order = np.lexsort((edge_mat[1], edge_mat[0]))
+    degree = np.bincount(edge_mat[0], minlength=num_nodes)
+    g.neighbor_offsets = np.concatenate([[0], np.cumsum(degree)]).astype(np.int32)
+    g.neighbor_index = edge_mat[1, order].astype(np.int32)
+    g.max_neighbor = int(degree.max())
+    if weights is not None:
+        g.edge_weight = torch.from_numpy(np.concatenate([weights, weights])[order])
 
 
 def separate_data(graph_list, seed, fold_idx):
     assert 0 <= fold_idx and fold_idx < 10, "fold_idx must be from 0 to 9."
     skf = StratifiedKFold(n_splits=10, shuffle = True, random_state = seed)
 
-    labels = [graph.label for graph in graph_list]
+    #graphs with several targets are stratified by the first target
+    labels = [graph.label if not isinstance(graph.label, tuple) else graph.label[0] for graph in graph_list]
     idx_list = []
     for idx in skf.split(np.zeros(len(labels)), labels):
         idx_list.append(idx)